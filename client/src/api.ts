@@ -145,9 +145,40 @@ export const getPlaygroundDocs = async (
   return await request(axios.get, `playgrounds/${playgroundId}/docs`);
 };
 
+const buildPollInterval = 1000;
+
+const waitForBuild = async (playgroundId: string) => {
+  while (true) {
+    const build = await request(axios.get, `playgrounds/${playgroundId}/build`);
+    if (build.status === "done") {
+      return;
+    }
+    if (build.status === "failed") {
+      throw new AxiosError(build.error || "Playground build failed");
+    }
+    await new Promise((resolve) => setTimeout(resolve, buildPollInterval));
+  }
+};
+
 export const getPlaygroundPoints = async (
   playgroundId: string,
+  onReplaced?: (points: PointModel[]) => void,
 ): Promise<PointModel[]> => {
+  const response = await axios.get(
+    `http://${host}:8000/playgrounds/${playgroundId}/plot-points`,
+  );
+  if (response.status !== 202) {
+    if (response.headers["x-projection-preview"] === "true" && onReplaced) {
+      waitForBuild(playgroundId)
+        .then(() =>
+          request(axios.get, `playgrounds/${playgroundId}/plot-points`),
+        )
+        .then(onReplaced)
+        .catch((error) => console.error("Failed to replace preview", error));
+    }
+    return response.data;
+  }
+  await waitForBuild(playgroundId);
   return await request(axios.get, `playgrounds/${playgroundId}/plot-points`);
 };
 
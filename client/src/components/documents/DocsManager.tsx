@@ -45,7 +45,8 @@ const DocsManager: React.FC<{
       const formData = new FormData();
       formData.append("file", file);
       return uploadDocument(formData).then((res) =>
-        setDocs((prev) => [res, ...prev]),
+        // Identical files resolve to the document that is already stored.
+        setDocs((prev) => [res, ...prev.filter((doc) => doc.id !== res.id)]),
       );
     });
 
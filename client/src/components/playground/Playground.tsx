@@ -21,9 +21,11 @@ const Playground: React.FC<{ playground: PlaygroundModel }> = (props) => {
   const [docs, loadingDocs, docsError, fetchDocs] = useAPI(
     getPlaygroundDocs.bind(null, props.playground.id),
   );
-  const [points, loadingPoints, pointsError, fetchPoints] = useAPI<
+  const [finalPoints, setFinalPoints] = useState<PointModel[] | null>(null);
+  const [previewPoints, loadingPoints, pointsError, fetchPoints] = useAPI<
     PointModel[]
-  >(getPlaygroundPoints.bind(null, props.playground.id));
+  >(getPlaygroundPoints.bind(null, props.playground.id, setFinalPoints));
+  const points = finalPoints || previewPoints;
   const [serverQueries, loadingQueries, queriesError, fetchQueries] = useAPI<
     QueryModel[]
   >(getQueries.bind(null, props.playground.id));
@@ -46,6 +48,7 @@ const Playground: React.FC<{ playground: PlaygroundModel }> = (props) => {
   }, [serverQueries]);
 
   useEffect(() => {
+    setFinalPoints(null);
     fetchAll();
     setChunks([]);
     setChunkIndex({});
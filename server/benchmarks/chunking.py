@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter, SentenceTransformersTokenTextSplitter
+from pypdf import PdfReader
+
+from benchmarks.synthetic_pdf import write_pdf
+from server.chunking import chunk_document
+from server.executors import shutdown_executors
+from server.schemas import ChunkingConfig, ChunkStrategy
+
+
+def legacy_chunk_document(file_path: str) -> list[str]:
+    # The chunker this pipeline replaced, kept verbatim as the baseline.
+    reader = PdfReader(file_path)
+    pdf_texts = [p.extract_text().strip() for p in reader.pages]
+    pdf_texts = [text for text in pdf_texts if text]
+
+    character_splitter = RecursiveCharacterTextSplitter(separators=["\n\n", "\n", ".", " ", ""], chunk_size=1000,
+                                                        chunk_overlap=0)
+
+    split_texts = character_splitter.split_text("\n\n".join(pdf_texts))
+    token_splitter = SentenceTransformersTokenTextSplitter(chunk_overlap=0, tokens_per_chunk=256)
+
+    token_split_texts = []
+    for text in split_texts:
+        token_split_texts += token_splitter.split_text(text)
+
+    split_texts = character_splitter.split_text("\n\n".join(pdf_texts))
+    return split_texts
+
+
+def report(name: str, started: float, chunks: list[str]):
+    _, peak = tracemalloc.get_traced_memory()
+    print(f"{name:<24} {time.perf_counter() - started:8.2f}s {len(chunks):8d} chunks "
+          f"{peak / 2 ** 20:8.1f} MiB peak (this process)")
+
+
+async def run(file_path: str, strategies: list[ChunkStrategy], skip_legacy: bool):
+    if not skip_legacy:
+        tracemalloc.start()
+        started = time.perf_counter()
+        report("legacy", started, legacy_chunk_document(file_path))
+        tracemalloc.stop()
+
+    for strategy in strategies:
+        config = ChunkingConfig(strategy=strategy, size=256 if strategy == ChunkStrategy.token else 1000)
+        tracemalloc.start()
+        started = time.perf_counter()
+        report(f"streaming/{strategy.value}", started, await chunk_document(file_path, config))
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the streaming PDF chunker with the legacy one.")
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--strategy", type=ChunkStrategy, action="append", choices=list(ChunkStrategy))
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "benchmark.pdf")
+        write_pdf(file_path, args.pages)
+        print(f"{args.pages} pages, {os.path.getsize(file_path) / 2 ** 20:.1f} MiB")
+        try:
+            asyncio.run(run(file_path, args.strategy or [ChunkStrategy.character], args.skip_legacy))
+        finally:
+            shutdown_executors()
+
+
+if __name__ == "__main__":
+    main()
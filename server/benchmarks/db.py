@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import hashlib
+import time
+
+from server import crud, db
+from server.db_utils import create_tables
+from server.schemas import ChunkingConfig
+
+
+async def timed(name: str, operations: int, coroutines):
+    started = time.perf_counter()
+    results = await asyncio.gather(*coroutines)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<20} {operations:8d} ops {elapsed:8.2f}s {operations / elapsed:10.1f} ops/s")
+    return results
+
+
+async def create_playground(pool, documents: list):
+    async with pool.acquire() as conn:
+        return await crud.create_playground(conn, "Sentence Transformers", "all-MiniLM-L6-v2", documents,
+                                            ChunkingConfig())
+
+
+async def read_playground(pool, playground_id):
+    async with pool.acquire() as conn:
+        playground = (await crud.read_playgrounds(conn, [playground_id]))[0]
+        await crud.read_playground_docs(conn, playground.id)
+
+
+async def delete_playground(pool, playground_id):
+    async with pool.acquire() as conn:
+        await crud.delete_playground(conn, playground_id)
+
+
+async def run(playgrounds: int, documents_per_playground: int, reads_per_playground: int):
+    pool = await db.create_pool()
+    try:
+        async with pool.acquire() as conn:
+            await create_tables(conn)
+            # Documents are only rows here, a hash of the name stands in for the file's.
+            documents = []
+            for i in range(documents_per_playground):
+                name = f"benchmark-{i}.pdf"
+                document, _ = await crud.create_doc(conn, name, hashlib.sha256(name.encode()).hexdigest(), 0)
+                documents.append(document.id)
+
+        created = await timed("create playground", playgrounds,
+                              [create_playground(pool, documents) for _ in range(playgrounds)])
+        playground_ids = [playground["id"] for playground in created]
+        await timed("read playground", playgrounds * reads_per_playground,
+                    [read_playground(pool, playground_id)
+                     for playground_id in playground_ids for _ in range(reads_per_playground)])
+        await timed("delete playground", playgrounds,
+                    [delete_playground(pool, playground_id) for playground_id in playground_ids])
+
+        async with pool.acquire() as conn:
+            for document_id in documents:
+                await crud.delete_doc(conn, document_id)
+    finally:
+        await db.close_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create, read and delete throughput of the Postgres data layer. "
+                                                 "Connects with the POSTGRES_* environment variables.")
+    parser.add_argument("--playgrounds", type=int, default=1000)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--reads", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.playgrounds, args.documents, args.reads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from benchmarks.mock_provider import MockProvider, fake_embedding
+from server import remote_embeddings
+from server.schemas import Service
+
+prefixes: dict[Service, str] = {
+    Service.openAI: "openai",
+    Service.cohere: "cohere",
+    Service.google: "google",
+}
+
+
+async def run(service: Service, texts: int, latency: float, error_rate: float):
+    provider = MockProvider(latency, error_rate)
+    runner, url = await provider.start()
+    remote_embeddings.base_urls[service] = f"{url}/{prefixes[service]}"
+    checkpointed = 0
+
+    async def checkpoint(batch: list[str], _):
+        nonlocal checkpointed
+        checkpointed += len(batch)
+
+    try:
+        chunks = [f"chunk {i} of the benchmark document" for i in range(texts)]
+        started = time.perf_counter()
+        embeddings = await remote_embeddings.embed_texts(service, "mock", chunks, on_batch=checkpoint)
+        elapsed = time.perf_counter() - started
+        assert np.allclose(embeddings[-1], fake_embedding(chunks[-1], provider.dimensions))
+        print(f"{service.value}: {texts} texts in {elapsed:.2f}s ({texts / elapsed:.0f} texts/s), "
+              f"{provider.requests} requests, {provider.errors} injected errors, "
+              f"{provider.max_in_flight} max in flight, {checkpointed} texts checkpointed")
+    finally:
+        await remote_embeddings.close_session()
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the remote embedding dispatcher against a local mock provider "
+                                                 "that injects latency and errors.")
+    parser.add_argument("--service", type=Service, choices=list(prefixes), default=Service.openAI)
+    parser.add_argument("--texts", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    args = parser.parse_args()
+    asyncio.run(run(args.service, args.texts, args.latency, args.error_rate))
+
+
+if __name__ == "__main__":
+    main()
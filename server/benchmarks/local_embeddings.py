@@ -0,0 +1,83 @@
+import argparse
+import importlib
+import json
+import random
+import time
+
+import numpy as np
+
+from benchmarks.synthetic_pdf import generate_sentence
+from server.local_embeddings import LocalBackend, LOCAL_EMBEDDING_THREADS, load_local_embedder
+
+MODEL = "all-MiniLM-L6-v2"
+
+
+def current_path(texts: list[str]) -> np.ndarray:
+    # What embed_texts did before the registry, a new chromadb embedding function per call.
+    embedding_functions = importlib.import_module("chromadb.utils.embedding_functions")
+    return np.array(embedding_functions.SentenceTransformerEmbeddingFunction(model_name=MODEL)(texts))
+
+
+def time_calls(embed, texts: list[str], queries: list[str]) -> dict:
+    started = time.perf_counter()
+    embeddings = np.asarray(embed(texts), dtype=np.float32)
+    elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    for query in queries:
+        embed([query])
+    query_latency = (time.perf_counter() - started) / max(len(queries), 1)
+    return {"texts_per_second": round(len(texts) / elapsed, 1), "query_ms": round(query_latency * 1000, 2)}, \
+        embeddings
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return float(np.mean(np.sum(a * b, axis=1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare local embedding backends with the previous per-call "
+                                                 "sentence-transformers path on synthetic chunks.")
+    parser.add_argument("--texts", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=LOCAL_EMBEDDING_THREADS)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    texts = [" ".join(generate_sentence(rng) for _ in range(rng.randint(1, 8))) for _ in range(args.texts)]
+    queries = [generate_sentence(rng) for _ in range(args.queries)]
+
+    variants = {"current": lambda: current_path}
+    for backend in LocalBackend:
+        for int8 in (False, True):
+            variants[f"{backend.value}{'-int8' if int8 else ''}"] = \
+                lambda backend=backend, int8=int8: load_local_embedder(MODEL, backend, int8, args.threads,
+                                                                       args.batch_size)
+
+    results, reference = {}, None
+    for name, load in variants.items():
+        try:
+            started = time.perf_counter()
+            embed = load()
+            load_seconds = time.perf_counter() - started
+            result, embeddings = time_calls(embed, texts, queries)
+        except (ImportError, ValueError, OSError) as e:
+            print(f"{name:<12} skipped: {e}")
+            continue
+        reference = embeddings if reference is None else reference
+        result.update(load_seconds=round(load_seconds, 2), cosine_to_first=round(cosine(embeddings, reference), 4))
+        results[name] = result
+        print(f"{name:<12} load {result['load_seconds']:6.2f}s  {result['texts_per_second']:8.1f} texts/s  "
+              f"query {result['query_ms']:7.2f}ms  cosine {result['cosine_to_first']:.4f}")
+
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump({"parameters": vars(args), "results": results}, out_file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import hashlib
+import random
+
+import numpy as np
+from aiohttp import web
+
+
+def fake_embedding(text: str, dimensions: int) -> list[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    embedding = np.random.default_rng(seed).standard_normal(dimensions, dtype=np.float32)
+    return (embedding / np.linalg.norm(embedding)).tolist()
+
+
+class MockProvider:
+    # Speaks just enough of the OpenAI, Cohere and Google embedding APIs for the dispatcher, with injected latency
+    # and a share of requests answered with a 429 or a 500.
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.1, dimensions: int = 384, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.dimensions = dimensions
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def respond(self, texts: list[str], body) -> web.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                if self.random.random() < 0.5:
+                    return web.json_response({"error": "rate limited"}, status=429, headers={"Retry-After": "0.1"})
+                return web.json_response({"error": "internal error"}, status=500)
+            return web.json_response(body([fake_embedding(text, self.dimensions) for text in texts]))
+        finally:
+            self.in_flight -= 1
+
+    async def openai(self, request: web.Request) -> web.Response:
+        texts = (await request.json())["input"]
+        return await self.respond(texts, lambda embeddings: {
+            "data": [{"index": i, "embedding": embedding} for i, embedding in enumerate(embeddings)]
+        })
+
+    async def cohere(self, request: web.Request) -> web.Response:
+        texts = (await request.json())["texts"]
+        return await self.respond(texts, lambda embeddings: {"embeddings": embeddings})
+
+    async def google(self, request: web.Request) -> web.Response:
+        texts = [r["content"]["parts"][0]["text"] for r in (await request.json())["requests"]]
+        return await self.respond(texts, lambda embeddings: {
+            "embeddings": [{"values": embedding} for embedding in embeddings]
+        })
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=2 ** 26)
+        app.router.add_post("/openai/embeddings", self.openai)
+        app.router.add_post("/cohere/embed", self.cohere)
+        app.router.add_post("/google/models/{model}", self.google)
+        return app
+
+    async def start(self, port: int = 0) -> tuple[web.AppRunner, str]:
+        runner = web.AppRunner(self.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        await site.start()
+        port = runner.addresses[0][1]
+        return runner, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI, Cohere and Google embedding endpoints. Point "
+                                                 "OPENAI_BASE_URL, COHERE_BASE_URL and GOOGLE_BASE_URL at "
+                                                 "<url>/openai, <url>/cohere and <url>/google.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.1)
+    parser.add_argument("--dimensions", type=int, default=384)
+    args = parser.parse_args()
+    provider = MockProvider(args.latency, args.error_rate, args.dimensions)
+    web.run_app(provider.app(), host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
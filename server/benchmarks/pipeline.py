@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import uuid
+
+import chromadb
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from benchmarks.mock_provider import MockProvider
+from benchmarks.synthetic_pdf import write_pdf
+from server import chroma, embedding_cache, file_store, mongo, remote_embeddings, umap_store
+from server.chunking import chunk_document
+from server.executors import shutdown_executors, CPU_WORKERS
+from server.schemas import ChunkingConfig, Playground, ProjectionConfig, ProjectionMethod, Service
+
+SERVICE = Service.openAI
+MODEL = "benchmark"
+WARMUP_PAGES = 5
+
+
+class StageTimer:
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+
+    async def time(self, stage: str, coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        self.stages[stage] = round(time.perf_counter() - started, 4)
+        print(f"  {stage:<36} {self.stages[stage]:8.2f}s")
+        return result
+
+
+async def run_corpus(pages: int, seed: int, queries: int, projection: ProjectionConfig,
+                     mongo_client: AsyncIOMotorClient, work_dir: str) -> dict:
+    # Every corpus gets its own text, so the embedding cache never carries over between them.
+    document_name = f"benchmark-{seed}.pdf"
+    write_pdf(file_store.get_path(document_name), pages, seed)
+    chroma_client = chromadb.PersistentClient(path=os.path.join(work_dir, f"chroma-{seed}"))
+    playground = Playground(id=uuid.uuid4(), title=document_name, created=datetime.datetime.now(), service=SERVICE,
+                            model=MODEL, projection_method=projection.method,
+                            projection_dimensions=projection.dimensions)
+    document_collection = str(uuid.uuid4())
+    timer = StageTimer()
+    print(f"{pages} pages")
+
+    chunks = await timer.time("chunk_document", chunk_document(file_store.get_path(document_name), ChunkingConfig()))
+    await timer.time("embed", chroma.embed(SERVICE, MODEL, chunks))
+    # Embeddings are cached by now, so this is chunking again plus the Chroma writes.
+    await timer.time("embed_document (cached embeddings)", chroma.embed_document(
+        chroma_client, document_collection, file_store.get_path(document_name), SERVICE, MODEL, ChunkingConfig()))
+    ids, coordinates = await timer.time("create_playground_points", chroma.create_playground_points(
+        chroma_client, playground, [document_collection]))
+
+    query_texts = [f"benchmark query {seed}-{i}" for i in range(queries)]
+    embedded_queries = await timer.time("embed queries", chroma.embed(SERVICE, MODEL, query_texts))
+    query_results = await timer.time("get_query_results", chroma.get_query_results(
+        chroma_client, [document_collection], embedded_queries))
+    query_points = await timer.time("create_query_points", chroma.create_query_points(
+        chroma_client, playground, [document_collection], embedded_queries,
+        [str(uuid.uuid4()) for _ in query_texts]))
+
+    if mongo_client is not None:
+        await timer.time("mongo save_projection", mongo.save_projection(
+            mongo_client, str(playground.id), ids, coordinates))
+        mongo.projection_cache.clear()
+        await timer.time("mongo get_projection", mongo.get_projection(mongo_client, str(playground.id)))
+        await timer.time("mongo insert_query_points", mongo.insert_query_points(
+            mongo_client, str(playground.id), query_points))
+        await mongo.delete_projection(mongo_client, str(playground.id))
+        await mongo.delete_query_points(mongo_client, str(playground.id))
+
+    return {
+        "pages": pages,
+        "chunks": len(chunks),
+        "points": len(ids),
+        "queries": len(query_results),
+        "stages": timer.stages,
+        "total": round(sum(timer.stages.values()), 4),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    provider = MockProvider(latency=args.latency, error_rate=0, dimensions=args.dimensions)
+    runner, url = await provider.start()
+    remote_embeddings.base_urls[SERVICE] = f"{url}/openai"
+    mongo_client = AsyncIOMotorClient(args.mongo_url) if args.mongo_url else None
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            file_store.file_store_path = os.path.join(work_dir, "files")
+            os.makedirs(file_store.file_store_path)
+            umap_store.umap_store_path = os.path.join(work_dir, "umap")
+            embedding_cache.embedding_cache_path = os.path.join(work_dir, "embedding_cache.sqlite3")
+            projection = ProjectionConfig(method=args.projection, dimensions=args.projection_dimensions)
+            # Spawning the CPU workers and compiling UMAP's numba code would otherwise land on the first corpus.
+            print("warm up")
+            await run_corpus(WARMUP_PAGES, 0, args.queries, projection, mongo_client, work_dir)
+            corpora = [await run_corpus(pages, seed, args.queries, projection, mongo_client, work_dir)
+                       for seed, pages in enumerate(args.pages, 1)]
+    finally:
+        await remote_embeddings.close_session()
+        await runner.cleanup()
+        if mongo_client is not None:
+            mongo_client.close()
+
+    return {
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                    "cpu_workers": CPU_WORKERS},
+        "parameters": {"dimensions": args.dimensions, "latency": args.latency, "queries": args.queries,
+                       "projection": args.projection.value, "projection_dimensions": args.projection_dimensions,
+                       "mongo": bool(args.mongo_url)},
+        "corpora": corpora,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each stage of the upload, plot-points and query path on "
+                                                 "synthetic PDFs, with deterministic embeddings served by a local "
+                                                 "mock provider.")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per embedding request")
+    parser.add_argument("--projection", type=ProjectionMethod, choices=list(ProjectionMethod),
+                        default=ProjectionMethod.umap)
+    parser.add_argument("--projection-dimensions", type=int, choices=[2, 3], default=2)
+    parser.add_argument("--mongo-url", help="e.g. mongodb://localhost:27017, Mongo stages are skipped without it")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        shutdown_executors()
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(results, out_file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
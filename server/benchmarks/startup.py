@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def child():
+    # Runs in a fresh interpreter so every measurement starts from cold imports.
+    started = time.perf_counter()
+    from server import api  # noqa: F401
+    imported = time.perf_counter() - started
+
+    from server import warmup
+    from server.executors import shutdown_executors
+    try:
+        asyncio.run(warmup.warm_up())
+    finally:
+        shutdown_executors()
+    print(json.dumps({"import": round(imported, 4), "warmup": round(warmup.warmup_seconds, 4), "warm": warmup.warm}))
+
+
+def run_child(env: dict[str, str]) -> dict:
+    result = subprocess.run([sys.executable, "-m", "benchmarks.startup", "--child"], env=env, capture_output=True,
+                            text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time importing the API and warming up its CPU workers, first with "
+                                                 "an empty numba cache and then with the one the first run left.")
+    parser.add_argument("--runs", type=int, default=3, help="Runs with a populated numba cache")
+    parser.add_argument("--cpu-workers", type=int, default=2)
+    parser.add_argument("--local-embeddings", action="store_true", help="Also load the local embedding model")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child()
+        return
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {**os.environ, "NUMBA_CACHE_DIR": cache_dir, "CPU_WORKERS": str(args.cpu_workers),
+               "WARMUP_LOCAL_EMBEDDINGS": str(args.local_embeddings).lower()}
+        cold = run_child(env)
+        print(f"cold cache:   import {cold['import']:6.2f}s   warmup {cold['warmup']:6.2f}s   {cold['warm']}")
+        cached = []
+        for _ in range(args.runs):
+            cached.append(run_child(env))
+            print(f"cached:       import {cached[-1]['import']:6.2f}s   warmup {cached[-1]['warmup']:6.2f}s")
+
+    results = {
+        "parameters": {"runs": args.runs, "cpu_workers": args.cpu_workers, "local_embeddings": args.local_embeddings},
+        "cold": cold,
+        "cached": cached,
+        "cached_median": {stage: statistics.median(run[stage] for run in cached) for stage in ("import", "warmup")},
+    }
+    print(f"median cached import {results['cached_median']['import']:.2f}s, "
+          f"warmup {results['cached_median']['warmup']:.2f}s")
+    if args.output:
+        with open(args.output, "w") as out_file:
+            json.dump(results, out_file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
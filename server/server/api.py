@@ -1,59 +1,105 @@
+import asyncio
 import logging
 import mimetypes
+import os
+import time
 import uuid
-from typing import Annotated, Any
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, Optional
 
-import chromadb
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
+from asyncpg import Connection
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Response
+from fastapi import Query as QueryParam
 from pydantic import UUID4
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
 
-from server import crud, mongo, chroma
-from server.chroma import get_query_results
+from server import crud, mongo, chroma, jobs, embedding_cache, db, remote_embeddings, metrics, warmup, \
+    query_cache
 from server.crud import read_docs, create_doc, delete_doc, create_playground, update_playground_title, \
-    read_playgrounds, create_query, read_queries
-from server.db import get_connection, release_connection
+    read_playgrounds, create_queries, read_queries
 from server.db_utils import create_tables
 from server.embedding_models import get_embedding_models, models
-from server.file_store import save_file, delete_file, get_path
-from server.mongo import get_mongo_client
+from server.executors import run_blocking, shutdown_executors
+from server.file_store import receive_file, store_file, discard_file, delete_file, get_file_name, file_response, \
+    UploadLimitMiddleware
+from server.points_codec import POINTS_MEDIA_TYPE, accepts_media_type, points_response, projection_to_points
+from server.umap_store import delete_umap_transform
 from server.schemas import EmbeddingModel, Document, Playground, RenamePlaygroundRequest, Point, Query, \
-    QueryResult, NewPlaygroundRequest, Chunk, Service
-from psycopg2.extensions import connection as Connection
+    QueryResult, NewPlaygroundRequest, Chunk, BatchQuery, Service, PlaygroundBuild, EmbeddingCacheStats, Neighbour, \
+    Readiness
 
 app = FastAPI()
 
-mongo_client = get_mongo_client()
-
-chroma_client = chromadb.PersistentClient(path="/chroma_path")
-
 logger = logging.getLogger(__name__)
 
+# Batch queries are embedded, searched, stored and placed this many at a time, and streamed back as each is done.
+BATCH_QUERY_SIZE = int(os.getenv("BATCH_QUERY_SIZE") or 32)
+
 origins = ["http://localhost:3000"]
 
+app.add_middleware(UploadLimitMiddleware, paths={"/documents/upload"})
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Projection-Preview", "X-Request-ID"],
 )
 
 
-def get_db_connection():
-    conn = get_connection()
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    token = metrics.request_id.set(request.headers.get("x-request-id") or uuid.uuid4().hex)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = metrics.request_id.get()
+        return response
+    finally:
+        # Routes are labelled by their template, so one playground doesn't make a series of its own.
+        route = request.scope.get("route")
+        metrics.http_request_duration.observe(time.perf_counter() - started, request.method,
+                                              route.path if route else "unmatched", str(status))
+        metrics.request_id.reset(token)
+
+
+async def get_db_connection():
+    # Time spent waiting here is the pool being saturated.
+    with metrics.span("db.acquire"):
+        conn = await db.get_pool().acquire()
     try:
         yield conn
     finally:
-        release_connection(conn)
+        await db.get_pool().release(conn)
 
 
 @app.on_event("startup")
 async def startup_event():
-    conn = get_connection()
-    create_tables(conn)
-    release_connection(conn)
+    # Only what a request can't do without happens here, models and numba code are warmed in the background.
+    await db.create_pool()
+    async with db.get_pool().acquire() as conn:
+        await create_tables(conn)
+    warmup.ready["database"] = True
+    await mongo.create_indexes(mongo.get_client())
+    warmup.ready["point_store"] = True
+    await run_blocking(chroma.get_client)
+    warmup.ready["vector_store"] = True
+    await jobs.start_workers(chroma.get_client(), mongo.get_client())
+    warmup.ready["build_workers"] = True
+    warmup.start_warmup()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await warmup.stop_warmup()
+    await jobs.stop_workers()
+    await db.close_pool()
+    await remote_embeddings.close_session()
+    shutdown_executors()
 
 
 @app.get("/playgrounds/all", response_model=list[Playground])
@@ -71,7 +117,8 @@ async def new_playground(conn: Annotated[Connection, Depends(get_db_connection)]
                          request: NewPlaygroundRequest) -> Playground:
     try:
         playground = await create_playground(conn, request.service,
-                                             models[Service(request.service)], request.documents)
+                                             models[Service(request.service)], request.documents, request.chunking,
+                                             request.projection)
         return playground
     except Exception as e:
         logger.error(f"Failed to create a new playground: {e}")
@@ -83,6 +130,24 @@ async def get_models() -> list[EmbeddingModel]:
     return get_embedding_models()
 
 
+@app.get("/ready", response_model=Readiness)
+async def get_readiness(response: Response) -> Readiness:
+    readiness = warmup.get_readiness()
+    if not readiness.ready:
+        response.status_code = 503
+    return readiness
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/embeddings/cache", response_model=EmbeddingCacheStats)
+async def get_embedding_cache_stats() -> EmbeddingCacheStats:
+    return await run_blocking(embedding_cache.get_cache_stats)
+
+
 @app.get("/documents/all", response_model=list[Document])
 async def get_docs(conn: Annotated[Connection, Depends(get_db_connection)]) -> list[Document]:
     try:
@@ -93,36 +158,63 @@ async def get_docs(conn: Annotated[Connection, Depends(get_db_connection)]) -> l
         raise HTTPException(status_code=500, detail="Cannot get uploaded documents at this time")
 
 
-@app.post("/documents/upload", response_model=Document)
-async def upload_file(conn: Annotated[Connection, Depends(get_db_connection)],
+@app.post("/documents/upload", response_model=Document, status_code=201)
+async def upload_file(conn: Annotated[Connection, Depends(get_db_connection)], response: Response,
                       file: UploadFile = File(...)) -> Document:
     try:
-        document = await create_doc(conn, file.filename)
-        await save_file(file)
+        temp_path, content_hash, size = await receive_file(file)
+        try:
+            # The file only takes its place once the row is inserted, and the row is only committed with the file in
+            # place, so a failed insert leaves nothing behind.
+            async with conn.transaction():
+                document, created = await create_doc(conn, file.filename, content_hash, size)
+                store_file(temp_path, content_hash)
+        finally:
+            discard_file(temp_path)
+        # A file that was already uploaded answers with the existing document, under the name it was first given.
+        if not created:
+            response.status_code = 200
         return document
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while uploading the file: {e}")
 
 
+async def delete_playground_data(playground_id: str):
+    # Everything a playground keeps outside Postgres.
+    query_cache.invalidate_playground(playground_id)
+    await run_blocking(delete_umap_transform, playground_id)
+    await chroma.delete_playground_collection(chroma.get_client(), playground_id)
+    await mongo.delete_query_points(mongo.get_client(), playground_id)
+    await mongo.delete_projection(mongo.get_client(), playground_id)
+
+
 @app.delete("/documents/{document_id}/delete", response_model=list[UUID4])
 async def delete_document(conn: Annotated[Connection, Depends(get_db_connection)], document_id: UUID4) -> list[UUID4]:
     try:
-        doc, playground_ids = await delete_doc(conn, document_id)
-        delete_file(doc.name)
+        doc, playground_ids, collection_names = await delete_doc(conn, document_id)
+        await run_blocking(delete_file, get_file_name(doc))
+        # Playgrounds that held the document went with it.
+        for playground_id in playground_ids:
+            await delete_playground_data(str(playground_id))
+        await chroma.delete_document_collections(chroma.get_client(), collection_names)
         return playground_ids
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while deleting the file: {e}")
 
 
 @app.get("/documents/{document_id}/download")
-async def download_document(conn: Annotated[Connection, Depends(get_db_connection)], document_id: UUID4):
+async def download_document(conn: Annotated[Connection, Depends(get_db_connection)], request: Request,
+                            document_id: UUID4):
     try:
         doc = (await read_docs(conn, [document_id]))[0]
-        document_path = get_path(doc.name)
-        mime_type, _ = mimetypes.guess_type(document_path)
+        mime_type, _ = mimetypes.guess_type(doc.name)
         if mime_type is None:
             mime_type = 'application/octet-stream'
-        return FileResponse(path=document_path, filename=doc.name, media_type=mime_type)
+        return file_response(request, doc, mime_type)
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Document not found")
 
@@ -142,6 +234,7 @@ async def delete_playground(conn: Annotated[Connection, Depends(get_db_connectio
                             playground_id: UUID4) -> UUID4:
     try:
         playground_id = await crud.delete_playground(conn, playground_id)
+        await delete_playground_data(str(playground_id))
         return playground_id
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred while deleting playground: {e}")
@@ -158,68 +251,218 @@ async def get_playground_documents(conn: Annotated[Connection, Depends(get_db_co
         raise HTTPException(status_code=500, detail=f"An error occurred while fetching playground {playground_id}: {e}")
 
 
-@app.get("/playgrounds/{playground_id}/plot-points", response_model=list[Point])
-async def get_plot(conn: Annotated[Connection, Depends(get_db_connection)], playground_id: UUID4) -> list[Point]:
+async def rebuild_playground(conn: Connection, playground_id: UUID4, refit: bool = False) -> PlaygroundBuild:
+    build = await crud.create_build(conn, playground_id, refit)
+    jobs.submit_build(str(playground_id))
+    return build
+
+
+async def check_not_building(conn: Connection, playground_id: UUID4):
+    if await jobs.is_building(conn, str(playground_id)):
+        raise HTTPException(status_code=409, detail="Playground is being built, try again when the build is done")
+
+
+@app.post("/playgrounds/{playground_id}/docs/{document_id}", response_model=PlaygroundBuild, status_code=202)
+async def add_playground_document(conn: Annotated[Connection, Depends(get_db_connection)],
+                                  playground_id: UUID4, document_id: UUID4) -> PlaygroundBuild:
+    await check_not_building(conn, playground_id)
     try:
-        playground = (await read_playgrounds(conn, [playground_id]))[0]
-        points = await mongo.get_points(mongo_client, str(playground.id))
-        if points:
-            return await mongo.get_points(mongo_client, str(playground.id))
+        await crud.add_playground_doc(conn, playground_id, document_id)
+        return await rebuild_playground(conn, playground_id)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many playground builds in progress, try again later")
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred while adding document {document_id} to playground: {e}")
 
-        if str(playground.id) not in [c.name for c in chroma_client.list_collections()]:
-            document_ids = await crud.read_playground_docs(conn, playground.id)
-            documents = await crud.read_docs(conn, document_ids)
-            embedded_document_ids = [
-                await crud.read_or_create_embedded_doc(conn, doc.id, playground.service.value, playground.model)
-                for doc in documents
-            ]
-            chroma.create_playground_collection(chroma_client, playground, documents, embedded_document_ids)
 
-        playground_points = chroma.create_playground_points(chroma_client, playground)
-        await mongo.create_points_collection(mongo_client, str(playground_id), playground_points)
-        return await mongo.get_points(mongo_client, str(playground.id))
+@app.delete("/playgrounds/{playground_id}/docs/{document_id}", response_model=PlaygroundBuild, status_code=202)
+async def remove_playground_document(conn: Annotated[Connection, Depends(get_db_connection)],
+                                     playground_id: UUID4, document_id: UUID4) -> PlaygroundBuild:
+    await check_not_building(conn, playground_id)
+    try:
+        await crud.delete_playground_doc(conn, playground_id, document_id)
+        return await rebuild_playground(conn, playground_id)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many playground builds in progress, try again later")
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred while removing document {document_id} from playground: {e}")
+
 
+@app.post("/playgrounds/{playground_id}/refit", response_model=PlaygroundBuild, status_code=202)
+async def refit_playground(conn: Annotated[Connection, Depends(get_db_connection)],
+                           playground_id: UUID4, force: bool = False) -> PlaygroundBuild:
+    await check_not_building(conn, playground_id)
+    playground = (await read_playgrounds(conn, [playground_id]))[0]
+    if not force and playground.drift < jobs.REFIT_DRIFT_THRESHOLD:
+        raise HTTPException(status_code=409, detail=f"Projection drift {playground.drift:.2f} is below the refit "
+                                                    f"threshold {jobs.REFIT_DRIFT_THRESHOLD:.2f}")
+    try:
+        return await rebuild_playground(conn, playground_id, refit=True)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many playground builds in progress, try again later")
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred while refitting playground {playground_id}: {e}")
+
+
+@app.get("/playgrounds/{playground_id}/plot-points", response_model=list[Point],
+         responses={200: {"content": {POINTS_MEDIA_TYPE: {}}}, 202: {"model": PlaygroundBuild}})
+async def get_plot(conn: Annotated[Connection, Depends(get_db_connection)], request: Request,
+                   response: Response, playground_id: UUID4) -> Any:
+    try:
+        playground = (await read_playgrounds(conn, [playground_id]))[0]
+        projection = await mongo.get_projection(mongo.get_client(), str(playground.id))
+        # Only looked up when it matters, it takes a round trip to Postgres to see builds in other workers.
+        building = (projection is None or projection.preview) and await jobs.is_building(conn, str(playground.id))
+        # A preview left behind by a build that didn't finish is served while the build runs again.
+        if projection is None or (projection.preview and not building):
+            build = await crud.read_build(conn, playground.id)
+            if build is None or not building:
+                build = await crud.create_build(conn, playground.id)
+                jobs.submit_build(str(playground.id))
+            if projection is None:
+                return JSONResponse(status_code=202, content=build.model_dump(mode="json"))
+
+        # Clients refetch a preview once the build is done, when the final layout replaces it.
+        headers = {"X-Projection-Preview": "true"} if projection.preview else {}
+        if accepts_media_type(request, POINTS_MEDIA_TYPE):
+            return points_response(request, projection, headers)
+        response.headers.update(headers)
+        return projection_to_points(projection)
+
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many playground builds in progress, try again later")
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail=f"An error occurred while fetching playground plot points {playground_id}: {e}")
 
 
+@app.get("/playgrounds/{playground_id}/build", response_model=PlaygroundBuild)
+async def get_build(conn: Annotated[Connection, Depends(get_db_connection)], playground_id: UUID4) -> PlaygroundBuild:
+    try:
+        build = await crud.read_build(conn, playground_id)
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred while fetching build status of playground {playground_id}: {e}")
+    if build is None:
+        raise HTTPException(status_code=404, detail="Playground build not found")
+    return build
+
+
 @app.get("/playgrounds/{playground_id}/chunks/{chunk_id}")
 async def get_chunk(conn: Annotated[Connection, Depends(get_db_connection)],
                     playground_id: UUID4, chunk_id: UUID4) -> Chunk:
     try:
         playground = (await read_playgrounds(conn, [playground_id]))[0]
-        return Chunk(id=chunk_id, text=chroma.get_chroma_chunk(chroma_client, playground, str(chunk_id)))
+        collection_names = await crud.read_playground_collections(conn, playground.id)
+        return Chunk(id=chunk_id, text=await chroma.get_chroma_chunk(chroma.get_client(), collection_names, str(chunk_id)))
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail=f"An error occurred while fetching chunk {chunk_id}: {e}")
 
 
+@app.get("/playgrounds/{playground_id}/chunks/{chunk_id}/neighbours", response_model=list[Neighbour])
+async def get_chunk_neighbours(conn: Annotated[Connection, Depends(get_db_connection)], playground_id: UUID4,
+                               chunk_id: UUID4, k: int = QueryParam(default=10, gt=0)) -> list[Neighbour]:
+    try:
+        playground = (await read_playgrounds(conn, [playground_id]))[0]
+        return await chroma.get_chunk_neighbours(playground, str(chunk_id), k)
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred while fetching neighbours of chunk {chunk_id}: {e}")
+
+
+async def submit_queries(conn: Connection, playground: Playground, texts: list[str]) -> list[QueryResult]:
+    collection_names = await crud.read_playground_collections(conn, playground.id)
+    # Search and projection share the one embedding of each query.
+    embedded_queries = await query_cache.embed_queries(playground.service, playground.model, texts)
+    results = await query_cache.get_query_results(chroma.get_client(), str(playground.id), collection_names,
+                                                  embedded_queries)
+    results = [[uuid.UUID(result) for result in query_results] for query_results in results]
+    # Checked before the queries are stored, so a playground that can't place them yet doesn't keep them either.
+    try:
+        await chroma.get_playground_umap_transform(playground)
+    except HTTPException:
+        # Playgrounds from before models were saved have none, and nothing will fit one until they're refitted.
+        if not await jobs.is_building(conn, str(playground.id)):
+            await rebuild_playground(conn, playground.id, refit=True)
+        raise
+    queries = await create_queries(conn, playground.id, texts, results)
+    query_points = await chroma.create_query_points(chroma.get_client(), playground, collection_names, embedded_queries,
+                                                    [str(query.id) for query in queries])
+    await mongo.insert_query_points(mongo.get_client(), str(playground.id), query_points)
+    for query, query_point in zip(queries, query_points):
+        query.point = query_point
+    return queries
+
+
 @app.post("/playgrounds/{playground_id}/query", response_model=QueryResult)
 async def query_playground(conn: Annotated[Connection, Depends(get_db_connection)],
                            playground_id: UUID4, query: Query) -> QueryResult:
     try:
         playground = (await read_playgrounds(conn, [playground_id]))[0]
-        results = get_query_results(chroma_client, playground, query.text)
-        results = [uuid.UUID(result) for result in results]
-        query = await create_query(conn, playground_id, query.text, results)
-        query_point = chroma.create_query_point(chroma_client, playground, query.text, str(query.id))
-        await mongo.insert_query_point(mongo_client, query_point)
-        return QueryResult(id=query.id,
-                           point=query_point, results=results, text=query.text)
+        return (await submit_queries(conn, playground, [query.text]))[0]
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail=f"An error occurred while submitting query {query}: {e}")
 
 
+async def stream_query_results(results: list[QueryResult], batches: list[list[str]],
+                               submit: Callable[[list[str]], Awaitable[list[QueryResult]]]) -> AsyncIterator[str]:
+    # The remaining batches are only submitted as the client reads, one NDJSON line per query in the order sent.
+    for query in results:
+        yield query.model_dump_json() + "\n"
+    for texts in batches:
+        for query in await submit(texts):
+            yield query.model_dump_json() + "\n"
+
+
+@app.post("/playgrounds/{playground_id}/query/batch", response_class=StreamingResponse,
+          responses={200: {"content": {"application/x-ndjson": {}}}})
+async def batch_query_playground(conn: Annotated[Connection, Depends(get_db_connection)],
+                                 playground_id: UUID4, batch: BatchQuery) -> StreamingResponse:
+    batches = [batch.texts[i:i + BATCH_QUERY_SIZE] for i in range(0, len(batch.texts), BATCH_QUERY_SIZE)]
+    try:
+        playground = (await read_playgrounds(conn, [playground_id]))[0]
+        # The first batch is submitted before responding, so a playground that can't take queries gets an error status.
+        results = await submit_queries(conn, playground, batches[0])
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred while submitting {len(batch.texts)} queries: {e}")
+
+    async def submit(texts: list[str]) -> list[QueryResult]:
+        # The request's connection is released before the body is sent.
+        try:
+            async with db.get_pool().acquire() as batch_conn:
+                return await submit_queries(batch_conn, playground, texts)
+        except Exception as e:
+            # The status has already been sent, the client sees the stream end early.
+            logger.error(f"Failed to submit {len(texts)} queries to playground {playground_id} mid stream: {e}")
+            raise
+
+    return StreamingResponse(stream_query_results(results, batches[1:], submit), media_type="application/x-ndjson")
+
+
 @app.get("/playgrounds/{playground_id}/query/all", response_model=list[QueryResult])
-async def get_queries(conn: Annotated[Connection, Depends(get_db_connection)],
-                      playground_id: UUID4) -> list[QueryResult]:
+async def get_queries(conn: Annotated[Connection, Depends(get_db_connection)], response: Response,
+                      playground_id: UUID4, cursor: Optional[str] = None,
+                      limit: Annotated[Optional[int], QueryParam(gt=0)] = None) -> list[QueryResult]:
     try:
-        queries = await read_queries(conn, playground_id)
+        queries, next_cursor = await read_queries(conn, playground_id, cursor, limit)
+        query_points = await mongo.get_query_points(mongo.get_client(), [str(query.id) for query in queries])
         for query in queries:
-            query.point = await mongo.get_mongo_query_point(mongo_client, str(query.id))
+            query.point = query_points.get(str(query.id))
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         return queries
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500,
                             detail=f"An error occurred while getting queries: {e}")
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+from server import metrics
+
+
+class LRUCache:
+    def __init__(self, max_size: int, name: str = None, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.name = name
+        # Entries older than ttl seconds count as missing, they are dropped when next looked up or evicted.
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        if name:
+            named_caches.append(self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                self.misses += 1
+                return default
+            if self.ttl is not None:
+                expires, value = self._items[key]
+                if expires < time.monotonic():
+                    del self._items[key]
+                    self.misses += 1
+                    return default
+            else:
+                value = self._items[key]
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._items[key] = value if self.ttl is None else (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._items:
+                return default
+            value = self._items.pop(key)
+            return value if self.ttl is None else value[1]
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        with self._lock:
+            keys = [key for key in self._items if predicate(key)]
+            for key in keys:
+                del self._items[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._items
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+
+named_caches: list[LRUCache] = []
+
+
+def collect_cache_metrics():
+    totals: dict[str, list[int]] = {}
+    for cache in named_caches:
+        total = totals.setdefault(cache.name, [0, 0, 0])
+        total[0] += cache.hits
+        total[1] += cache.misses
+        total[2] += len(cache)
+    for name, (hits, misses, entries) in totals.items():
+        metrics.cache_hits.set_total(hits, name)
+        metrics.cache_misses.set_total(misses, name)
+        metrics.cache_entries.set(entries, name)
+
+
+metrics.collectors.append(collect_cache_metrics)
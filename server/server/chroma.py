@@ -1,108 +1,355 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import os
 import uuid
+from typing import Awaitable, Callable, Optional, TYPE_CHECKING
 
-import chromadb
 import numpy as np
-import umap
-from chromadb import ClientAPI
-from chromadb.api.models.Collection import Collection
-from langchain.text_splitter import RecursiveCharacterTextSplitter, SentenceTransformersTokenTextSplitter
-from pydantic import UUID4
-from pypdf import PdfReader
-from server.embedding_models import get_embedding_function
-from server.file_store import get_path
-from server.schemas import Service, Point, Document, Playground, Chunk
-
-
-def chunk_document(document_name: str):
-    file_path = get_path(document_name)
-    reader = PdfReader(file_path)
-    pdf_texts = [p.extract_text().strip() for p in reader.pages]
-    pdf_texts = [text for text in pdf_texts if text]
-
-    character_splitter = RecursiveCharacterTextSplitter(separators=["\n\n", "\n", ".", " ", ""], chunk_size=1000,
-                                                        chunk_overlap=0)
-
-    split_texts = character_splitter.split_text("\n\n".join(pdf_texts))
-    token_splitter = SentenceTransformersTokenTextSplitter(chunk_overlap=0, tokens_per_chunk=256)
-
-    token_split_texts = []
-    for text in split_texts:
-        token_split_texts += token_splitter.split_text(text)
-
-    split_texts = character_splitter.split_text("\n\n".join(pdf_texts))
-    return split_texts
-
-
-def embed_document(client: ClientAPI, document_collection: str, document_name: str, service: Service, model: str):
-    if document_collection in [c.name for c in client.list_collections()]:
-        return client.get_collection(document_collection)
-
-    doc_chunks = chunk_document(document_name)
-    ids = [str(uuid.uuid4()) for _ in doc_chunks]
-    embedding_function = get_embedding_function(service, model)
-
-    chroma_collection = client.create_collection(document_collection, embedding_function=embedding_function)
-    chroma_collection.add(ids=ids, documents=doc_chunks)
-    return chroma_collection
-
-
-def create_playground_collection(client: ClientAPI, playground: Playground, documents: list[Document],
-                                 embedded_document_ids: list[UUID4]) -> Collection:
-    embedding_function = get_embedding_function(playground.service, playground.model)
-    chroma_collection = client.create_collection(str(playground.id), embedding_function=embedding_function)
-
-    for i, doc in enumerate(documents):
-        embedded_document_id = embedded_document_ids[i]
-        doc_collection = embed_document(client, str(embedded_document_id), doc.name,
-                                        playground.service, playground.model)
-        doc_vectors = doc_collection.get(include=['embeddings'])
-        chroma_collection.add(ids=doc_vectors['ids'], embeddings=doc_vectors['embeddings'],
-                              documents=[doc_collection.name for _ in doc_vectors['ids']])
-    return chroma_collection
-
-
-def create_playground_points(client: ClientAPI, playground: Playground) -> list[Point]:
-    collection = client.get_collection(str(playground.id))
-    data = collection.get(include=["embeddings"])
-    embeddings, ids = data["embeddings"], data["ids"]
-    umap_transform = get_umap_transform(embeddings)
-    projected_embeddings = project_embeddings(embeddings, umap_transform)
+from fastapi import HTTPException
+from server import embedding_cache, metrics, remote_embeddings
+from server.chunking import iter_document_chunks
+from server.collection_registry import get_registry
+from server.embedding_models import embed_texts, is_local
+from server.executors import run_blocking, run_cpu, run_embedding, API_WORKERS
+from server.metrics import timed
+from server.paths import DATA_PATH
+from server.points_codec import Projection, uuid_bytes
+from server.projection import as_matrix, fit_projection, has_preview, get_preview_config, project_embeddings, \
+    KNNGraph, KNN_NEIGHBORS, NeighbourUMAP
+from server.schemas import Service, Point, Playground, ChunkingConfig, Neighbour
+from server.umap_store import save_umap_transform, load_umap_transform, save_knn_graph, load_knn_graph
+
+if TYPE_CHECKING:
+    from chromadb import ClientAPI
+    from chromadb.api.models.Collection import Collection
+
+KNN_QUERY_BATCH_SIZE = int(os.getenv("KNN_QUERY_BATCH_SIZE") or 1024)
+CHROMA_PATH = os.getenv("CHROMA_PATH") or DATA_PATH
+# Set to reach a Chroma server instead of opening the store in this process, which several API workers need.
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT") or 8000)
+
+chroma_client: Optional[ClientAPI] = None
+
+
+def get_client() -> ClientAPI:
+    global chroma_client
+    if chroma_client is None:
+        import chromadb
+        if CHROMA_HOST:
+            chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+        elif API_WORKERS > 1:
+            raise RuntimeError("An embedded Chroma store can't be shared by several API workers, set CHROMA_HOST")
+        else:
+            chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
+    return chroma_client
+
+
+@timed
+async def embed(service: Service, model: str, texts: list[str]) -> np.ndarray:
+    embeddings = await run_blocking(embedding_cache.get_embeddings, service, model, texts)
+    missing_texts = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing_texts:
+        metrics.embedded_texts.inc(service.value, model, amount=len(missing_texts))
+        if is_local(service):
+            new_embeddings = as_matrix(await run_embedding(embed_texts, service, model, missing_texts))
+            await run_blocking(embedding_cache.put_embeddings, service, model, missing_texts, new_embeddings)
+        else:
+            async def checkpoint(batch: list[str], batch_embeddings: list[list[float]]):
+                await run_blocking(embedding_cache.put_embeddings, service, model, batch, as_matrix(batch_embeddings))
+
+            new_embeddings = as_matrix(await remote_embeddings.embed_texts(service, model, missing_texts,
+                                                                           on_batch=checkpoint))
+        embedded = dict(zip(missing_texts, new_embeddings))
+        embeddings = [embedded[text] if embedding is None else embedding
+                      for text, embedding in zip(texts, embeddings)]
+    return as_matrix(embeddings)
+
+
+def collection_exists(client: ClientAPI, collection_name: str) -> bool:
+    return get_registry(client).exists(collection_name)
+
+
+@timed
+async def embed_document(client: ClientAPI, document_collection: str, document_path: str, service: Service,
+                         model: str, chunking: ChunkingConfig) -> Collection:
+    registry = get_registry(client)
+    if await run_blocking(collection_exists, client, document_collection):
+        return await run_blocking(registry.get, document_collection)
+
+    # Chunks are embedded range by range into a staging collection, which only takes the final name once the
+    # whole document is in, so an interrupted run never leaves a half-filled document collection behind.
+    partial_collection = f"{document_collection}-partial"
+    if await run_blocking(collection_exists, client, partial_collection):
+        await run_blocking(registry.delete, partial_collection)
+    chroma_collection = await run_blocking(registry.create, partial_collection)
+
+    async for doc_chunks in iter_document_chunks(document_path, chunking):
+        if not doc_chunks:
+            continue
+        ids = [str(uuid.uuid4()) for _ in doc_chunks]
+        embeddings = await embed(service, model, doc_chunks)
+        await run_blocking(chroma_collection.add, ids=ids, embeddings=embeddings.tolist(), documents=doc_chunks)
+        registry.add_chunks(chroma_collection, ids)
+
+    return await run_blocking(registry.rename, chroma_collection, document_collection)
+
+
+@timed
+async def get_playground_collections(client: ClientAPI, collection_names: list[str]) -> list[Collection]:
+    registry = get_registry(client)
+    if all(registry.is_cached(name) for name in collection_names):
+        return [registry.get(name) for name in collection_names]
+    return list(await asyncio.gather(*(run_blocking(registry.get, name) for name in collection_names)))
+
+
+@timed
+async def delete_playground_collection(client: ClientAPI, playground_id: str):
+    # Playgrounds used to hold their own copy of every vector, drop it if one is still around.
+    if await run_blocking(collection_exists, client, playground_id):
+        await run_blocking(get_registry(client).delete, playground_id)
+
+
+@timed
+async def delete_document_collections(client: ClientAPI, collection_names: list[str]):
+    # A document's collections along with any staging copy an interrupted build left.
+    for collection_name in collection_names:
+        for name in [collection_name, f"{collection_name}-partial"]:
+            if await run_blocking(collection_exists, client, name):
+                await run_blocking(get_registry(client).delete, name)
+
+
+@timed
+async def get_playground_embeddings(client: ClientAPI, collection_names: list[str]) -> tuple[list[str], np.ndarray]:
+    collections = await get_playground_collections(client, collection_names)
+    data = await asyncio.gather(*(run_blocking(c.get, include=["embeddings"]) for c in collections))
+    ids = [chunk_id for collection_data in data for chunk_id in collection_data["ids"]]
+    embeddings = [as_matrix(collection_data["embeddings"]) for collection_data in data if collection_data["ids"]]
+    return ids, np.concatenate(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+
+@timed
+async def create_playground_points(client: ClientAPI, playground: Playground, collection_names: list[str],
+                                   on_preview: Callable[[list[str], np.ndarray], Awaitable] = None
+                                   ) -> tuple[list[str], np.ndarray]:
+    ids, embeddings = await get_playground_embeddings(client, collection_names)
+    if on_preview is not None and has_preview(playground.projection):
+        preview = await run_cpu(fit_projection, embeddings, get_preview_config(playground.projection))
+        await on_preview(ids, preview.embedding_)
+    collections = await get_playground_collections(client, collection_names)
+    knn_graph = await get_knn_graph(collections, ids, embeddings, KNN_NEIGHBORS)
+    await run_blocking(save_knn_graph, str(playground.id), knn_graph)
+    projection_model = await run_cpu(fit_projection, embeddings, playground.projection, knn_graph, collection_names)
+    await run_blocking(save_umap_transform, str(playground.id), projection_model)
+    return ids, projection_model.embedding_
+
+
+@timed
+async def update_playground_points(client: ClientAPI, playground: Playground, collection_names: list[str],
+                                   projection: Projection) -> Optional[tuple[list[str], np.ndarray, int]]:
+    umap_transform = await run_blocking(load_umap_transform, str(playground.id))
+    if umap_transform is None:
+        return None
+
+    # Points of removed documents are dropped and only chunks missing from the projection are embedded into the
+    # existing layout, which stays put.
+    collections = await get_playground_collections(client, collection_names)
+    # A layout fitted before its collections were kept, or none of whose documents are left, is refitted instead.
+    if isinstance(umap_transform, NeighbourUMAP) and not umap_transform.collections & set(collection_names):
+        return None
+    data = await asyncio.gather(*(run_blocking(c.get, include=[]) for c in collections))
+    current_ids = {chunk_id for collection_data in data for chunk_id in collection_data["ids"]}
+    projected_ids = [str(uuid.UUID(bytes=point_id.tobytes())) for point_id in projection.ids]
+    keep = np.fromiter((point_id in current_ids for point_id in projected_ids), dtype=bool, count=len(projected_ids))
+
+    known_ids = set(projected_ids)
+    missing = [(c, [chunk_id for chunk_id in collection_data["ids"] if chunk_id not in known_ids])
+               for c, collection_data in zip(collections, data)]
+    missing = [(c, chunk_ids) for c, chunk_ids in missing if chunk_ids]
+    added = await asyncio.gather(*(run_blocking(c.get, ids=chunk_ids, include=["embeddings"])
+                                   for c, chunk_ids in missing))
+
+    ids = [point_id for point_id, kept in zip(projected_ids, keep) if kept]
+    coordinates = projection.coordinates[keep]
+    new_ids = [chunk_id for added_data in added for chunk_id in added_data["ids"]]
+    embeddings = np.concatenate([as_matrix(added_data["embeddings"]) for added_data in added]) if new_ids \
+        else np.empty((0, 0), dtype=np.float32)
+    if new_ids:
+        projected = await transform_embeddings(collections, embeddings, umap_transform)
+        ids += new_ids
+        coordinates = np.concatenate([coordinates, as_matrix(projected)[:, :coordinates.shape[1]]])
+
+    # Chunk neighbours are served from the graph, which follows the same changes.
+    knn_graph = await run_blocking(load_knn_graph, str(playground.id))
+    if knn_graph is not None and (new_ids or not keep.all()):
+        knn_graph = await update_knn_graph(collections, knn_graph, current_ids, new_ids, embeddings)
+        await run_blocking(save_knn_graph, str(playground.id), knn_graph)
+    return ids, coordinates, len(new_ids) + int((~keep).sum())
+
+
+@timed
+async def get_knn_graph(collections: list[Collection], ids: list[str], embeddings: np.ndarray, k: int) -> KNNGraph:
+    # Every chunk is already in an HNSW index, asking it for neighbours is far cheaper than UMAP's own
+    # nearest neighbour descent. Rows a playground is too small to fill are left disconnected.
+    rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+    indices, distances = await query_knn_rows(collections, rows, embeddings, k)
+    return KNNGraph(ids=uuid_bytes(ids), indices=indices, distances=distances)
+
+
+async def query_knn_rows(collections: list[Collection], rows: dict[str, int], embeddings: np.ndarray,
+                         k: int) -> tuple[np.ndarray, np.ndarray]:
+    indices = np.full((len(embeddings), k), -1, dtype=np.int32)
+    distances = np.full((len(embeddings), k), np.inf, dtype=np.float32)
+    for start in range(0, len(embeddings), KNN_QUERY_BATCH_SIZE):
+        neighbour_ids, neighbour_distances = await query_neighbours(
+            collections, embeddings[start:start + KNN_QUERY_BATCH_SIZE], k)
+        for row, (chunk_ids, chunk_distances) in enumerate(zip(neighbour_ids, neighbour_distances), start):
+            neighbours = [(rows[chunk_id], distance) for chunk_id, distance in zip(chunk_ids, chunk_distances)
+                          if chunk_id in rows]
+            if neighbours:
+                indices[row, :len(neighbours)], distances[row, :len(neighbours)] = zip(*neighbours)
+    return indices, distances
+
+
+@timed
+async def update_knn_graph(collections: list[Collection], knn_graph: KNNGraph, current_ids: set[str],
+                           new_ids: list[str], new_embeddings: np.ndarray) -> KNNGraph:
+    # Rows of removed chunks are dropped along with every edge to them, and the remaining edges are renumbered.
+    # Chunks that stay keep the neighbours they were fitted with, new chunks get theirs from the current collections.
+    graph_ids = [str(uuid.UUID(bytes=point_id.tobytes())) for point_id in knn_graph.ids]
+    keep = np.fromiter((chunk_id in current_ids for chunk_id in graph_ids), dtype=bool, count=len(graph_ids))
+    renumbered = np.full(len(graph_ids), -1, dtype=np.int32)
+    renumbered[keep] = np.arange(keep.sum())
+    indices = np.where(knn_graph.indices >= 0, renumbered[knn_graph.indices], -1)[keep]
+    distances = np.where(indices >= 0, knn_graph.distances[keep], np.inf).astype(np.float32)
+    order = np.argsort(indices < 0, axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+
+    ids = [chunk_id for chunk_id, kept in zip(graph_ids, keep) if kept] + new_ids
+    if new_ids:
+        rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+        new_indices, new_distances = await query_knn_rows(collections, rows, new_embeddings, indices.shape[1])
+        indices = np.concatenate([indices, new_indices])
+        distances = np.concatenate([distances, new_distances])
+    return KNNGraph(ids=uuid_bytes(ids), indices=indices.astype(np.int32), distances=distances)
+
+
+def get_fitted_collections(collections: list[Collection], projection_model: NeighbourUMAP) -> list[Collection]:
+    if not projection_model.collections:
+        return collections
+    return [c for c in collections if c.name in projection_model.collections]
+
+
+@timed
+async def transform_embeddings(collections: list[Collection], embeddings: np.ndarray,
+                               projection_model) -> np.ndarray:
+    if isinstance(projection_model, NeighbourUMAP):
+        # Only chunks with a row in the layout are searched, not the chunks being placed or those placed earlier.
+        fitted_collections = get_fitted_collections(collections, projection_model)
+        neighbour_ids, neighbour_distances = await query_neighbours(fitted_collections, embeddings, KNN_NEIGHBORS)
+        return projection_model.place(neighbour_ids, neighbour_distances)
+    return await run_blocking(project_embeddings, embeddings, projection_model)
+
+
+@timed
+async def get_chunk_neighbours(playground: Playground, chunk_id: str, k: int) -> list[Neighbour]:
+    knn_graph = await run_blocking(load_knn_graph, str(playground.id))
+    if knn_graph is None:
+        raise HTTPException(status_code=404, detail="Playground has no neighbour graph")
+    chunk_bytes = np.frombuffer(uuid.UUID(chunk_id).bytes, dtype=np.uint8)
+    rows = np.flatnonzero((knn_graph.ids == chunk_bytes).all(axis=1))
+    if not len(rows):
+        raise HTTPException(status_code=404, detail="Chunk not found in neighbour graph")
+
+    row = rows[0]
     return [
-        Point(id=ids[i], x=point[0], y=point[1], z=0)
-        for i, point in enumerate(projected_embeddings)
+        Neighbour(id=uuid.UUID(bytes=knn_graph.ids[index].tobytes()), distance=float(distance))
+        for index, distance in zip(knn_graph.indices[row], knn_graph.distances[row])
+        if index >= 0 and index != row
+    ][:k]
+
+
+def create_points(ids: list[str], projected_embeddings: np.ndarray) -> list[Point]:
+    coordinates = np.zeros((len(projected_embeddings), 3), dtype=np.float32)
+    coordinates[:, :projected_embeddings.shape[1]] = projected_embeddings[:, :3]
+    return [
+        Point.model_construct(id=point_id, x=x, y=y, z=z)
+        for point_id, (x, y, z) in zip(ids, coordinates.tolist())
     ]
 
 
-def project_embeddings(embeddings, umap_transform):
-    umap_embeddings = np.empty((len(embeddings), 2))
-    for i, embedding in enumerate(embeddings):
-        umap_embeddings[i] = umap_transform.transform([embedding])
-    return umap_embeddings
+@timed
+async def get_chroma_chunk(client: ClientAPI, collection_names: list[str], chunk_id: str) -> str:
+    registry = get_registry(client)
+    collections = await get_playground_collections(client, collection_names)
+    # Once the owning collection of a chunk is known only that one is asked, and only if its text is not cached.
+    chunk_collection = [c for c in collections if c.id == registry.get_chunk_collection(chunk_id)]
+    if chunk_collection:
+        text = registry.get_chunk_text(chunk_id)
+        if text is not None:
+            return text
+        collections = chunk_collection
+
+    results = await asyncio.gather(*(run_blocking(c.get, ids=[chunk_id], include=["documents"]) for c in collections))
+    for collection, result in zip(collections, results):
+        if result["documents"]:
+            registry.put_chunk_text(collection, chunk_id, result["documents"][0])
+            return result["documents"][0]
+    raise HTTPException(status_code=404, detail="Chunk not found")
+
+
+@timed
+async def query_neighbours(collections: list[Collection], query_embeddings: np.ndarray,
+                           n_results: int) -> tuple[list[list[str]], list[list[float]]]:
+    # Every document collection returns its own top k, so the k best of their union are the exact top k
+    # over the whole playground. Chroma reports squared euclidean distances.
+    results = await asyncio.gather(*(
+        run_blocking(c.query, query_embeddings=query_embeddings.tolist(), n_results=n_results, include=["distances"])
+        for c in collections
+    ))
+    merged_ids, merged_distances = [], []
+    for i in range(len(query_embeddings)):
+        candidates = [
+            (distance, chunk_id)
+            for result in results
+            for chunk_id, distance in zip(result["ids"][i], result["distances"][i])
+        ]
+        nearest = heapq.nsmallest(n_results, candidates)
+        merged_ids.append([chunk_id for _, chunk_id in nearest])
+        merged_distances.append([max(distance, 0) ** 0.5 for distance, _ in nearest])
+    return merged_ids, merged_distances
 
 
-def get_umap_transform(embeddings):
-    return umap.UMAP(random_state=0, transform_seed=0).fit(embeddings)
+@timed
+async def query_collections(collections: list[Collection], query_embeddings: np.ndarray,
+                            n_results: int) -> list[list[str]]:
+    return (await query_neighbours(collections, query_embeddings, n_results))[0]
 
 
-def get_chroma_chunk(client: ClientAPI, playground: Playground, chunk_id: str) -> str:
-    collection = client.get_collection(str(playground.id))
-    doc_collection_id = collection.get(ids=[chunk_id], include=["documents"])["documents"][0]
-    doc_collection = client.get_collection(doc_collection_id)
-    return doc_collection.get(ids=[chunk_id], include=["documents"])["documents"][0]
+@timed
+async def get_query_results(client: ClientAPI, collection_names: list[str], embedded_queries: np.ndarray,
+                            n_results: int = 5) -> list[list[str]]:
+    collections = await get_playground_collections(client, collection_names)
+    return await query_collections(collections, embedded_queries, n_results)
 
 
-def get_query_results(client: ClientAPI, playground: Playground, query: str) -> list[str]:
-    collection = client.get_collection(str(playground.id))
-    results = collection.query(query_texts=[query], n_results=5)
-    return results['ids'][0]
+@timed
+async def get_playground_umap_transform(playground: Playground):
+    # Only builds fit projections, a query arriving before the build has saved one is turned away rather than
+    # fitting a second one alongside it.
+    umap_transform = await run_blocking(load_umap_transform, str(playground.id))
+    if umap_transform is None:
+        raise HTTPException(status_code=409, detail="The playground's projection is still being built")
+    return umap_transform
 
 
-def create_query_point(client: ClientAPI, playground: Playground, query: str, query_id: str) -> Point:
-    collection = client.get_collection(str(playground.id))
-    data = collection.get(include=["embeddings"])
-    embeddings = data["embeddings"]
-    umap_transform = get_umap_transform(embeddings)
-    embedding_function = get_embedding_function(playground.service, playground.model)
-    embedded_query = embedding_function([query])[0]
-    query_point = project_embeddings([embedded_query], umap_transform)[0]
-    return Point(id=query_id, x=query_point[0], y=query_point[1], z=0)
+@timed
+async def create_query_points(client: ClientAPI, playground: Playground, collection_names: list[str],
+                              embedded_queries: np.ndarray, query_ids: list[str]) -> list[Point]:
+    umap_transform = await get_playground_umap_transform(playground)
+    collections = await get_playground_collections(client, collection_names)
+    projected_queries = await transform_embeddings(collections, embedded_queries, umap_transform)
+    return create_points(query_ids, projected_queries)
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+from collections import deque
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Iterable, Iterator, TYPE_CHECKING
+
+from server.executors import run_blocking, run_cpu, CPU_WORKERS
+from server.schemas import ChunkingConfig, ChunkStrategy
+
+if TYPE_CHECKING:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter, SentenceTransformersTokenTextSplitter
+
+PAGES_PER_TASK = int(os.getenv("PAGES_PER_TASK") or 32)
+CHUNKING_WINDOW = int(os.getenv("CHUNKING_WINDOW") or CPU_WORKERS * 2)
+
+SEPARATORS = ["\n\n", "\n", ".", " ", ""]
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
+def count_pages(file_path: str) -> int:
+    from pypdf import PdfReader
+    return len(PdfReader(file_path).pages)
+
+
+def iter_pages(file_path: str, start: int, stop: int) -> Iterator[str]:
+    from pypdf import PdfReader
+    reader = PdfReader(file_path)
+    for i in range(start, min(stop, len(reader.pages))):
+        text = reader.pages[i].extract_text().strip()
+        if text:
+            yield text
+
+
+@lru_cache
+def get_character_splitter(chunk_size: int) -> RecursiveCharacterTextSplitter:
+    # langchain and pypdf are imported by the functions that use them, which mostly run in the CPU workers.
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=chunk_size, chunk_overlap=0)
+
+
+@lru_cache
+def get_token_splitter(tokens_per_chunk: int) -> SentenceTransformersTokenTextSplitter:
+    from langchain.text_splitter import SentenceTransformersTokenTextSplitter
+    splitter = SentenceTransformersTokenTextSplitter(chunk_overlap=0)
+    splitter.tokens_per_chunk = min(tokens_per_chunk, splitter.maximum_tokens_per_chunk)
+    return splitter
+
+
+def iter_paragraphs(pages: Iterable[str]) -> Iterator[str]:
+    for page in pages:
+        for paragraph in page.split("\n\n"):
+            if paragraph.strip():
+                yield paragraph
+
+
+def iter_sentences(pages: Iterable[str]) -> Iterator[str]:
+    for paragraph in iter_paragraphs(pages):
+        for sentence in SENTENCE_BOUNDARY.split(paragraph):
+            if sentence.strip():
+                yield sentence
+
+
+def split_oversized(pieces: Iterable[str], chunk_size: int, length: Callable[[str], int],
+                    split: Callable[[str], list[str]]) -> Iterator[str]:
+    for piece in pieces:
+        if length(piece) > chunk_size:
+            yield from split(piece)
+        else:
+            yield piece
+
+
+def pack_chunks(pieces: Iterable[str], chunk_size: int, chunk_overlap: int, length: Callable[[str], int],
+                separator: str) -> Iterator[str]:
+    current: deque[tuple[str, int]] = deque()
+    current_length = 0
+    for piece in pieces:
+        piece_length = length(piece)
+        if current and current_length + piece_length > chunk_size:
+            yield separator.join(text for text, _ in current)
+            # Carry over trailing pieces that fit in the overlap window.
+            while current and (current_length > chunk_overlap or current_length + piece_length > chunk_size):
+                current_length -= current.popleft()[1]
+        current.append((piece, piece_length))
+        current_length += piece_length
+    if current:
+        yield separator.join(text for text, _ in current)
+
+
+def chunk_texts(pages: Iterable[str], config: ChunkingConfig) -> Iterator[str]:
+    if config.strategy == ChunkStrategy.token:
+        token_splitter = get_token_splitter(config.size)
+
+        def count_tokens(text: str) -> int:
+            return token_splitter.count_tokens(text=text)
+
+        pieces = split_oversized(iter_paragraphs(pages), token_splitter.tokens_per_chunk, count_tokens,
+                                 token_splitter.split_text)
+        return pack_chunks(pieces, token_splitter.tokens_per_chunk, config.overlap, count_tokens, "\n\n")
+
+    separator = " " if config.strategy == ChunkStrategy.sentence else "\n\n"
+    pieces = iter_sentences(pages) if config.strategy == ChunkStrategy.sentence else iter_paragraphs(pages)
+
+    def count_characters(text: str) -> int:
+        return len(text) + len(separator)
+
+    pieces = split_oversized(pieces, config.size, len, get_character_splitter(config.size).split_text)
+    return pack_chunks(pieces, config.size, config.overlap, count_characters, separator)
+
+
+def chunk_pages(file_path: str, start: int, stop: int, config: ChunkingConfig) -> list[str]:
+    return list(chunk_texts(iter_pages(file_path, start, stop), config))
+
+
+async def iter_document_chunks(file_path: str, config: ChunkingConfig) -> AsyncIterator[list[str]]:
+    # Page ranges are chunked in the CPU pool and yielded in page order, with at most CHUNKING_WINDOW ranges
+    # in flight, so the text of a large document is never held in memory at once.
+    # Chunks do not span page range boundaries.
+    page_count = await run_blocking(count_pages, file_path)
+    pending: deque[asyncio.Future] = deque()
+    try:
+        for start in range(0, page_count, PAGES_PER_TASK):
+            pending.append(asyncio.ensure_future(run_cpu(chunk_pages, file_path, start, start + PAGES_PER_TASK,
+                                                         config)))
+            if len(pending) >= CHUNKING_WINDOW:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+async def chunk_document(file_path: str, config: ChunkingConfig) -> list[str]:
+    chunks = []
+    async for range_chunks in iter_document_chunks(file_path, config):
+        chunks += range_chunks
+    return chunks
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import os
+import threading
+import uuid
+from typing import Optional, TYPE_CHECKING
+from weakref import WeakKeyDictionary
+
+from server.cache import LRUCache
+from server.executors import API_WORKERS
+
+if TYPE_CHECKING:
+    from chromadb import ClientAPI
+    from chromadb.api.models.Collection import Collection
+
+CHUNK_INDEX_SIZE = int(os.getenv("CHUNK_INDEX_SIZE") or 1_000_000)
+CHUNK_TEXT_CACHE_SIZE = int(os.getenv("CHUNK_TEXT_CACHE_SIZE") or 10_000)
+
+
+class CollectionRegistry:
+    # Collection handles and names are cached for the lifetime of the client, so every create, rename and delete
+    # has to go through the registry to keep it in sync.
+    def __init__(self, client: ClientAPI):
+        self.client = client
+        self._lock = threading.Lock()
+        self._names: Optional[set[str]] = None
+        self._collections: dict[str, Collection] = {}
+        # Chunk ids map to the collection id rather than its name, which survives renames.
+        self._chunk_collections = LRUCache(CHUNK_INDEX_SIZE, "chunk_collection")
+        self._chunk_texts = LRUCache(CHUNK_TEXT_CACHE_SIZE, "chunk_text")
+
+    def _load_names(self) -> set[str]:
+        with self._lock:
+            if self._names is None:
+                self._names = {c.name for c in self.client.list_collections()}
+            return self._names
+
+    def _register(self, collection: Collection) -> Collection:
+        with self._lock:
+            self._collections[collection.name] = collection
+            if self._names is not None:
+                self._names.add(collection.name)
+        return collection
+
+    def _forget(self, name: str):
+        with self._lock:
+            self._collections.pop(name, None)
+            if self._names is not None:
+                self._names.discard(name)
+
+    def is_cached(self, name: str) -> bool:
+        return name in self._collections
+
+    def exists(self, name: str) -> bool:
+        if name in self._collections or name in self._load_names():
+            return True
+        if API_WORKERS > 1:
+            # Other workers create collections too, so a name this process hasn't seen is looked up again.
+            with self._lock:
+                self._names = None
+            return name in self._load_names()
+        return False
+
+    def get(self, name: str) -> Collection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._register(self.client.get_collection(name))
+        return collection
+
+    def create(self, name: str) -> Collection:
+        return self._register(self.client.create_collection(name))
+
+    def rename(self, collection: Collection, name: str) -> Collection:
+        previous_name = collection.name
+        collection.modify(name=name)
+        self._forget(previous_name)
+        return self._register(collection)
+
+    def delete(self, name: str):
+        self.client.delete_collection(name)
+        self._forget(name)
+
+    def add_chunks(self, collection: Collection, ids: list[str]):
+        for chunk_id in ids:
+            self._chunk_collections.put(chunk_id, collection.id)
+
+    def get_chunk_collection(self, chunk_id: str) -> Optional[uuid.UUID]:
+        return self._chunk_collections.get(chunk_id)
+
+    def get_chunk_text(self, chunk_id: str) -> Optional[str]:
+        return self._chunk_texts.get(chunk_id)
+
+    def put_chunk_text(self, collection: Collection, chunk_id: str, text: str):
+        self._chunk_collections.put(chunk_id, collection.id)
+        self._chunk_texts.put(chunk_id, text)
+
+    def clear(self):
+        with self._lock:
+            self._names = None
+            self._collections.clear()
+        self._chunk_collections.clear()
+        self._chunk_texts.clear()
+
+
+registries: "WeakKeyDictionary[ClientAPI, CollectionRegistry]" = WeakKeyDictionary()
+registries_lock = threading.Lock()
+
+
+def get_registry(client: ClientAPI) -> CollectionRegistry:
+    with registries_lock:
+        registry = registries.get(client)
+        if registry is None:
+            registry = registries[client] = CollectionRegistry(client)
+        return registry
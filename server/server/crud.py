@@ -1,97 +1,164 @@
+import base64
+import datetime
 import logging
+import uuid
+from typing import Optional
 
+from asyncpg import Connection
 from fastapi import HTTPException
 from pydantic import UUID4
 
 from server.db_utils import execute_query
-from server.schemas import Document, Playground, QueryResult
-from psycopg2.extensions import connection as Connection
+from server.metrics import timed
+from server.schemas import Document, Playground, QueryResult, PlaygroundBuild, BuildStage, BuildStatus, \
+    ChunkingConfig, ProjectionConfig
 
 logger = logging.getLogger(__name__)
 
 
+@timed
 async def read_docs(conn: Connection, doc_ids: list[UUID4] = None) -> list[Document]:
     if doc_ids:
         doc_ids = [str(uuid) for uuid in doc_ids]
 
-        query = "SELECT * FROM document WHERE id = ANY(%s::UUID[])"
+        query = "SELECT * FROM document WHERE id = ANY($1::UUID[])"
         result = await execute_query(conn, query, (doc_ids,))
         if not result:
             raise HTTPException(status_code=404, detail="Document(s) not found")
     else:
         query = "SELECT * FROM document"
-        result = await execute_query(conn, query, (doc_ids,))
+        result = await execute_query(conn, query)
     return [Document(**document) for document in result]
 
 
+@timed
 async def read_playground_docs(conn: Connection, playground_id: UUID4) -> list[UUID4]:
-    query = "SELECT document_id FROM playground_document_association where playground_id = %s"
+    query = "SELECT document_id FROM playground_document_association where playground_id = $1"
     document_ids = await execute_query(conn, query, (str(playground_id),))
     return [document_id['document_id'] for document_id in document_ids]
 
 
-async def create_doc(conn: Connection, name: str) -> Document:
-    query = "INSERT INTO document (name) VALUES (%s) RETURNING *;"
-    params = (name,)
-    return await execute_query(conn, query, params, fetch_one=True)
+@timed
+async def create_doc(conn: Connection, name: str, content_hash: str, size: int) -> tuple[Document, bool]:
+    # A file that was already uploaded, under any name, resolves to the existing document and its embeddings.
+    query = """
+    INSERT INTO document (name, content_hash, size) VALUES ($1, $2, $3)
+    ON CONFLICT (content_hash) DO UPDATE SET content_hash = EXCLUDED.content_hash
+    RETURNING *, xmax = 0 AS created;
+    """
+    params = (name, content_hash, size)
+    document = await execute_query(conn, query, params, fetch_one=True)
+    created = document.pop("created")
+    return Document(**document), created
 
 
-async def delete_doc(conn: Connection, doc_id: UUID4) -> tuple[Document, list[UUID4]]:
+@timed
+async def delete_doc(conn: Connection, doc_id: UUID4) -> tuple[Document, list[UUID4], list[str]]:
     params = (str(doc_id),)
 
     delete_playgrounds_query = """
     DELETE FROM playground WHERE id IN (
         SELECT playground_id FROM playground_document_association 
-        WHERE document_id = %s
+        WHERE document_id = $1
     )
     RETURNING id
     """
-    playground_ids = await execute_query(conn, delete_playgrounds_query, params)
-
-    delete_document_query = "DELETE FROM document WHERE id = %s RETURNING *;"
+    # The embedded documents would go with the document anyway, their ids name the Chroma collections to drop.
+    delete_embedded_documents_query = "DELETE FROM embedded_document WHERE document_id = $1 RETURNING id;"
+    delete_document_query = "DELETE FROM document WHERE id = $1 RETURNING *;"
 
-    document = await execute_query(conn, delete_document_query, params, fetch_one=True)
+    async with conn.transaction():
+        playground_ids = await execute_query(conn, delete_playgrounds_query, params)
+        embedded_documents = await execute_query(conn, delete_embedded_documents_query, params)
+        document = await execute_query(conn, delete_document_query, params, fetch_one=True)
 
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
-    return Document(**document), [playground_id['id'] for playground_id in playground_ids]
+    return (Document(**document), [playground_id['id'] for playground_id in playground_ids],
+            [str(embedded_document['id']) for embedded_document in embedded_documents])
 
 
-async def create_playground(conn: Connection, service: str, model: str, documents: list[UUID4]) -> Playground:
+@timed
+async def create_playground(conn: Connection, service: str, model: str, documents: list[UUID4],
+                            chunking: ChunkingConfig, projection: ProjectionConfig = ProjectionConfig()) -> Playground:
     docs = await read_docs(conn, documents)
 
-    insert_playground_query = "INSERT INTO playground (service, model) VALUES (%s, %s) RETURNING *"
-    playground = await execute_query(conn, insert_playground_query, (service, model), fetch_one=True)
+    insert_playground_query = """
+    INSERT INTO playground (service, model, chunk_strategy, chunk_size, chunk_overlap, projection_method,
+                            projection_dimensions)
+    VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING *
+    """
+    params = (service, model, chunking.strategy.value, chunking.size, chunking.overlap, projection.method.value,
+              projection.dimensions)
 
     associate_documents_query = """
     INSERT INTO playground_document_association (playground_id, document_id)
-    VALUES (%s, %s);
+    SELECT $1, unnest($2::UUID[]);
     """
 
-    for doc in docs:
-        await execute_query(conn, associate_documents_query, (str(playground['id']), str(doc.id)), fetch_all=False)
+    async with conn.transaction():
+        playground = await execute_query(conn, insert_playground_query, params, fetch_one=True)
+        await execute_query(conn, associate_documents_query, (playground['id'], [doc.id for doc in docs]),
+                            fetch_all=False)
 
     return playground
 
 
+@timed
+async def add_playground_doc(conn: Connection, playground_id: UUID4, document_id: UUID4):
+    await read_docs(conn, [document_id])
+    query = """
+    INSERT INTO playground_document_association (playground_id, document_id) VALUES ($1, $2)
+    ON CONFLICT DO NOTHING RETURNING document_id;
+    """
+    added = await execute_query(conn, query, (str(playground_id), str(document_id)), fetch_one=True)
+    if not added:
+        raise HTTPException(status_code=409, detail="Document is already in the playground")
+
+
+@timed
+async def delete_playground_doc(conn: Connection, playground_id: UUID4, document_id: UUID4):
+    query = """
+    DELETE FROM playground_document_association WHERE playground_id = $1 AND document_id = $2
+    RETURNING document_id;
+    """
+    deleted = await execute_query(conn, query, (str(playground_id), str(document_id)), fetch_one=True)
+    if not deleted:
+        raise HTTPException(status_code=404, detail="Document not found in playground")
+
+
+@timed
+async def reset_playground_drift(conn: Connection, playground_id: UUID4, fitted_points: int):
+    query = "UPDATE playground SET fitted_points = $1, changed_points = 0 WHERE id = $2;"
+    await execute_query(conn, query, (fitted_points, str(playground_id)), fetch_all=False)
+
+
+@timed
+async def add_playground_drift(conn: Connection, playground_id: UUID4, changed_points: int):
+    query = "UPDATE playground SET changed_points = changed_points + $1 WHERE id = $2;"
+    await execute_query(conn, query, (changed_points, str(playground_id)), fetch_all=False)
+
+
+@timed
 async def read_playgrounds(conn: Connection, playground_ids: list[UUID4] = None) -> list[Playground]:
     if playground_ids:
         playground_ids = [str(playground_id) for playground_id in playground_ids]
-        query = "SELECT * FROM playground WHERE id = ANY(%s::UUID[])"
+        query = "SELECT * FROM playground WHERE id = ANY($1::UUID[])"
         result = await execute_query(conn, query, (playground_ids,))
         if not result:
             raise HTTPException(status_code=404, detail="Playground(s) not found")
     else:
         query = "SELECT * FROM playground"
-        result = await execute_query(conn, query, (playground_ids,))
+        result = await execute_query(conn, query)
     return [Playground(**playground) for playground in result]
 
 
+@timed
 async def update_playground_title(conn: Connection, playground_id: UUID4, new_title: str) -> UUID4:
     update_query = """
             UPDATE playground
-            SET title = %s
-            WHERE id = %s
+            SET title = $1
+            WHERE id = $2
             RETURNING id;
         """
     updated = await execute_query(conn, update_query, (new_title, str(playground_id)), fetch_one=True)
@@ -100,10 +167,11 @@ async def update_playground_title(conn: Connection, playground_id: UUID4, new_ti
     return updated['id']
 
 
+@timed
 async def delete_playground(conn: Connection, playground_id: UUID4) -> UUID4:
     params = (str(playground_id),)
 
-    delete_playground_query = "DELETE FROM playground WHERE id = %s RETURNING id;"
+    delete_playground_query = "DELETE FROM playground WHERE id = $1 RETURNING id;"
     playground_id = await execute_query(conn, delete_playground_query, params, fetch_one=True)
 
     if not playground_id:
@@ -111,34 +179,164 @@ async def delete_playground(conn: Connection, playground_id: UUID4) -> UUID4:
     return playground_id['id']
 
 
-async def read_embedded_doc(conn: Connection, document_id: UUID4, service: str, model: str) -> UUID4:
-    query = "SELECT id FROM embedded_document WHERE document_id = %s AND service = %s AND model = %s;"
-    result = await execute_query(conn, query, (str(document_id), service, model), fetch_one=True)
-    if not result:
-        raise HTTPException(status_code=404, detail="Embedded document not found")
-    return result['id']
+@timed
+async def read_or_create_embedded_doc(conn: Connection, document_id: UUID4, service: str, model: str,
+                                      chunking: ChunkingConfig) -> UUID4:
+    # One statement on the unique config index, concurrent builds of the same document get the same row.
+    query = """
+    INSERT INTO embedded_document (document_id, service, model, chunk_strategy, chunk_size, chunk_overlap)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (document_id, service, model, chunk_strategy, chunk_size, chunk_overlap)
+    DO UPDATE SET document_id = EXCLUDED.document_id
+    RETURNING id;
+    """
+    params = (str(document_id), service, model, chunking.strategy.value, chunking.size, chunking.overlap)
+    return (await execute_query(conn, query, params, fetch_one=True))['id']
+
+
+@timed
+async def read_playground_collections(conn: Connection, playground_id: UUID4) -> list[str]:
+    query = """
+    SELECT e.id FROM playground p
+    JOIN playground_document_association a ON a.playground_id = p.id
+    JOIN embedded_document e ON e.document_id = a.document_id
+    WHERE p.id = $1 AND e.service = p.service AND e.model = p.model AND e.chunk_strategy = p.chunk_strategy
+    AND e.chunk_size = p.chunk_size AND e.chunk_overlap = p.chunk_overlap;
+    """
+    result = await execute_query(conn, query, (str(playground_id),))
+    return [str(embedded_document['id']) for embedded_document in result]
+
+
+@timed
+async def create_queries(conn: Connection, playground_id: UUID4, query_texts: list[str],
+                         results: list[list[UUID4]]) -> list[QueryResult]:
+    query_ids = [uuid.uuid4() for _ in query_texts]
+    query = """
+    INSERT INTO query (id, playground_id, text, results)
+    SELECT q.id, $1, q.text, q.results::UUID[]
+    FROM unnest($2::UUID[], $3::VARCHAR[], $4::TEXT[]) AS q(id, text, results)
+    RETURNING *;
+    """
+    # Results go in as Postgres array literals, since unnest would flatten a two-dimensional UUID array.
+    results_literals = ["{" + ",".join(str(r) for r in query_results) + "}" for query_results in results]
+    rows = await execute_query(conn, query, (str(playground_id), query_ids, query_texts, results_literals))
+    queries = {row['id']: QueryResult(**row) for row in rows}
+    return [queries[query_id] for query_id in query_ids]
 
 
-async def create_embedded_doc(conn: Connection, document_id: UUID4, service: str, model: str) -> UUID4:
-    query = "INSERT INTO embedded_document (document_id, service, model) VALUES (%s, %s, %s) RETURNING id;"
-    return (await execute_query(conn, query, (str(document_id), service, model), fetch_one=True))['id']
+def encode_query_cursor(query: QueryResult) -> str:
+    return base64.urlsafe_b64encode(f"{query.created.isoformat()}|{query.id}".encode()).decode()
 
 
-async def read_or_create_embedded_doc(conn: Connection, document_id: UUID4, service: str, model: str) -> UUID4:
+def decode_query_cursor(cursor: str) -> tuple[datetime.datetime, uuid.UUID]:
     try:
-        return await read_embedded_doc(conn, document_id, service, model)
-    except HTTPException:
-        return await create_embedded_doc(conn, document_id, service, model)
+        created, query_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(created), uuid.UUID(query_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@timed
+async def read_queries(conn: Connection, playground_id: UUID4, cursor: str = None,
+                       limit: int = None) -> tuple[list[QueryResult], Optional[str]]:
+    created, query_id = decode_query_cursor(cursor) if cursor else (None, None)
+    query = """
+    SELECT * FROM query
+    WHERE playground_id = $1 AND ($2::TIMESTAMPTZ IS NULL OR (created, id) > ($2, $3::UUID))
+    ORDER BY created, id
+    LIMIT $4;
+    """
+    result = await execute_query(conn, query, (str(playground_id), created, query_id, limit))
+    queries = [QueryResult(**query) for query in result]
+    next_cursor = encode_query_cursor(queries[-1]) if limit and len(queries) == limit else None
+    return queries, next_cursor
 
 
-async def create_query(conn: Connection, playground_id: UUID4, query_text: str, results: list[UUID4]) -> QueryResult:
-    query = "INSERT INTO query (playground_id, text, results) VALUES (%s, %s, %s::UUID[]) RETURNING *;"
-    result = await execute_query(conn, query, (str(playground_id),
-                                               query_text, [str(r) for r in results]), fetch_one=True)
-    return QueryResult(**result)
+@timed
+async def try_lock(conn: Connection, key: str) -> bool:
+    # Session level advisory locks, held by the connection until released or until it closes with its process.
+    query = "SELECT pg_try_advisory_lock(hashtextextended($1, 0)) AS locked;"
+    return (await execute_query(conn, query, (key,), fetch_one=True))["locked"]
 
 
-async def read_queries(conn: Connection, playground_id: UUID4) -> list[QueryResult]:
-    query = "SELECT * FROM query WHERE playground_id = %s"
-    result = await execute_query(conn, query, (str(playground_id),))
-    return [QueryResult(**query) for query in result]
+@timed
+async def lock(conn: Connection, key: str):
+    await execute_query(conn, "SELECT pg_advisory_lock(hashtextextended($1, 0));", (key,), fetch_all=False)
+
+
+@timed
+async def unlock(conn: Connection, key: str):
+    await execute_query(conn, "SELECT pg_advisory_unlock(hashtextextended($1, 0));", (key,), fetch_all=False)
+
+
+@timed
+async def is_locked(conn: Connection, key: str) -> bool:
+    # Read from pg_locks rather than by taking the lock, a probe holding it for a moment would make the worker
+    # that owns the build think another one has it. A bigint advisory key is split into classid and objid.
+    query = """
+    SELECT EXISTS (
+        SELECT 1 FROM pg_locks, (SELECT hashtextextended($1, 0) AS key) k
+        WHERE locktype = 'advisory' AND granted AND objsubid = 1
+        AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+        AND classid = ((k.key >> 32) & 4294967295)::OID AND objid = (k.key & 4294967295)::OID
+    ) AS locked;
+    """
+    return (await execute_query(conn, query, (key,), fetch_one=True))["locked"]
+
+
+@timed
+async def create_build(conn: Connection, playground_id: UUID4, refit: bool = False) -> PlaygroundBuild:
+    query = """
+    INSERT INTO playground_build (playground_id, refit) VALUES ($1, $2)
+    ON CONFLICT (playground_id) DO UPDATE
+    SET status = 'queued', error = NULL, updated = CURRENT_TIMESTAMP,
+        completed_stages = CASE WHEN playground_build.status = 'done' THEN '{}'
+                                ELSE playground_build.completed_stages END,
+        refit = $2 OR (playground_build.status <> 'done' AND playground_build.refit)
+    RETURNING *;
+    """
+    return PlaygroundBuild(**await execute_query(conn, query, (str(playground_id), refit), fetch_one=True))
+
+
+@timed
+async def read_build(conn: Connection, playground_id: UUID4) -> Optional[PlaygroundBuild]:
+    query = "SELECT * FROM playground_build WHERE playground_id = $1;"
+    result = await execute_query(conn, query, (str(playground_id),), fetch_one=True)
+    return PlaygroundBuild(**result) if result else None
+
+
+@timed
+async def read_pending_builds(conn: Connection) -> list[PlaygroundBuild]:
+    query = "SELECT * FROM playground_build WHERE status IN ('queued', 'running');"
+    result = await execute_query(conn, query)
+    return [PlaygroundBuild(**build) for build in result]
+
+
+@timed
+async def update_build_stage(conn: Connection, playground_id: UUID4, stage: BuildStage, progress: float):
+    query = """
+    UPDATE playground_build
+    SET status = 'running', stage = $1, progress = $2, updated = CURRENT_TIMESTAMP
+    WHERE playground_id = $3;
+    """
+    await execute_query(conn, query, (stage.value, progress, str(playground_id)), fetch_all=False)
+
+
+@timed
+async def complete_build_stage(conn: Connection, playground_id: UUID4, stage: BuildStage):
+    query = """
+    UPDATE playground_build
+    SET completed_stages = array_append(completed_stages, $1::VARCHAR), progress = 1, updated = CURRENT_TIMESTAMP
+    WHERE playground_id = $2 AND NOT ($1::VARCHAR = ANY(completed_stages));
+    """
+    await execute_query(conn, query, (stage.value, str(playground_id)), fetch_all=False)
+
+
+@timed
+async def finish_build(conn: Connection, playground_id: UUID4, status: BuildStatus, error: str = None):
+    query = """
+    UPDATE playground_build
+    SET status = $1, stage = NULL, error = $2, updated = CURRENT_TIMESTAMP
+    WHERE playground_id = $3;
+    """
+    await execute_query(conn, query, (status.value, error, str(playground_id)), fetch_all=False)
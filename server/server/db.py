@@ -1,27 +1,75 @@
 import os
+import time
 
-from psycopg2 import pool
-from psycopg2.extensions import connection as Connection
-import psycopg2.extras
+import asyncpg
+from asyncpg import Connection, Pool
+
+from server import metrics
 
 PG_USER = os.getenv("POSTGRES_USER")
 PG_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 PG_DB = os.getenv("POSTGRES_DB")
-PG_HOST = "db"
+PG_HOST = os.getenv("POSTGRES_HOST") or "db"
+
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE") or 2)
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE") or 20)
+PG_STATEMENT_CACHE_SIZE = int(os.getenv("PG_STATEMENT_CACHE_SIZE") or 256)
+PG_MAX_IDLE_SECONDS = float(os.getenv("PG_MAX_IDLE_SECONDS") or 300)
+PG_HEALTH_CHECK = (os.getenv("PG_HEALTH_CHECK") or "true").lower() == "true"
+PG_HEALTH_CHECK_INTERVAL_SECONDS = float(os.getenv("PG_HEALTH_CHECK_INTERVAL_SECONDS") or 30)
+
+connection_pool: Pool | None = None
+# When each server backend, by pid, was last handed out, so connections in steady use skip the round trip.
+last_checked: dict[int, float] = {}
+
+
+async def check_connection(conn: Connection):
+    # Runs on acquire, a connection that sat unused for a while is checked before a handler gets it, so one dropped
+    # by the server is noticed there.
+    if not PG_HEALTH_CHECK:
+        return
+    pid = conn.get_server_pid()
+    now = time.monotonic()
+    if pid not in last_checked or now - last_checked[pid] >= PG_HEALTH_CHECK_INTERVAL_SECONDS:
+        await conn.execute("SELECT 1")
+    last_checked[pid] = now
+
+
+async def create_pool() -> Pool:
+    global connection_pool
+    # asyncpg prepares every statement it runs and keeps it in a per-connection LRU, so the hot queries in
+    # crud.py are parsed and planned once per connection.
+    connection_pool = await asyncpg.create_pool(user=PG_USER,
+                                                password=PG_PASSWORD,
+                                                database=PG_DB,
+                                                host=PG_HOST,
+                                                min_size=PG_POOL_MIN_SIZE,
+                                                max_size=PG_POOL_MAX_SIZE,
+                                                statement_cache_size=PG_STATEMENT_CACHE_SIZE,
+                                                max_inactive_connection_lifetime=PG_MAX_IDLE_SECONDS,
+                                                setup=check_connection)
+    return connection_pool
+
 
+async def close_pool():
+    global connection_pool
+    if connection_pool is not None:
+        await connection_pool.close()
+        connection_pool = None
+    last_checked.clear()
 
-psycopg2.extras.register_uuid()
 
-connection_pool = pool.SimpleConnectionPool(1, 10,
-                                            user=PG_USER,
-                                            password=PG_PASSWORD,
-                                            database=PG_DB,
-                                            host=PG_HOST)
+def get_pool() -> Pool:
+    return connection_pool
 
 
-def get_connection() -> Connection:
-    return connection_pool.getconn()
+def collect_pool_metrics():
+    if connection_pool is None:
+        return
+    idle = connection_pool.get_idle_size()
+    metrics.db_pool_connections.set(connection_pool.get_size() - idle, "busy")
+    metrics.db_pool_connections.set(idle, "idle")
+    metrics.db_pool_connections.set(connection_pool.get_max_size(), "max")
 
 
-def release_connection(conn):
-    connection_pool.putconn(conn)
+metrics.collectors.append(collect_pool_metrics)
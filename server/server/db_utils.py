@@ -1,25 +1,23 @@
+import logging
 from typing import Any, Optional, Union, Tuple, List
-from psycopg2.extensions import connection as Connection
 
-import psycopg2.extras
-import logging
+from asyncpg import Connection
 
 logger = logging.getLogger(__name__)
 
-Params = Optional[Union[Any, Tuple[Any, ...], List[Any]]]
+Params = Optional[Union[Tuple[Any, ...], List[Any]]]
 
 
 async def execute_query(conn: Connection, query: str, params: Params = None, fetch_all: bool = True,
                         fetch_one: bool = False):
     try:
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
-            cursor.execute(query, params)
-            conn.commit()
-            if fetch_one:
-                result = cursor.fetchone()
-                return dict(result) if result else None
-            if fetch_all:
-                return [dict(row) for row in cursor.fetchall()]
+        params = params or ()
+        if fetch_one:
+            result = await conn.fetchrow(query, *params)
+            return dict(result) if result else None
+        if fetch_all:
+            return [dict(row) for row in await conn.fetch(query, *params)]
+        await conn.execute(query, *params)
     except Exception as e:
         logger.error(f"Database error: {e}")
         raise
@@ -63,12 +61,73 @@ CREATE_TABLES_SQL = [
     text VARCHAR(255),
     results UUID[]
     );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS playground_build (
+    playground_id UUID PRIMARY KEY REFERENCES playground(id) ON DELETE CASCADE,
+    status VARCHAR(255) NOT NULL DEFAULT 'queued',
+    stage VARCHAR(255),
+    completed_stages VARCHAR(255)[] NOT NULL DEFAULT '{}',
+    progress REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    updated TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    ALTER TABLE playground
+    ADD COLUMN IF NOT EXISTS chunk_strategy VARCHAR(255) NOT NULL DEFAULT 'character',
+    ADD COLUMN IF NOT EXISTS chunk_size INTEGER NOT NULL DEFAULT 1000,
+    ADD COLUMN IF NOT EXISTS chunk_overlap INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE embedded_document
+    ADD COLUMN IF NOT EXISTS chunk_strategy VARCHAR(255) NOT NULL DEFAULT 'character',
+    ADD COLUMN IF NOT EXISTS chunk_size INTEGER NOT NULL DEFAULT 1000,
+    ADD COLUMN IF NOT EXISTS chunk_overlap INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE query ADD COLUMN IF NOT EXISTS created TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP;
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS query_playground_created_idx ON query (playground_id, created, id);
+    """,
+    """
+    ALTER TABLE playground
+    ADD COLUMN IF NOT EXISTS fitted_points INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS changed_points INTEGER NOT NULL DEFAULT 0;
+    """,
+    """
+    ALTER TABLE playground_build ADD COLUMN IF NOT EXISTS refit BOOLEAN NOT NULL DEFAULT FALSE;
+    """,
+    """
+    ALTER TABLE playground
+    ADD COLUMN IF NOT EXISTS projection_method VARCHAR(255) NOT NULL DEFAULT 'umap',
+    ADD COLUMN IF NOT EXISTS projection_dimensions INTEGER NOT NULL DEFAULT 2;
+    """,
+    """
+    ALTER TABLE document
+    ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64),
+    ADD COLUMN IF NOT EXISTS size BIGINT;
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS document_content_hash_idx ON document (content_hash);
+    """,
+    """
+    -- Builds that raced before the unique index existed could create duplicates, keep one row per config.
+    DELETE FROM embedded_document a USING embedded_document b
+    WHERE a.id > b.id AND a.document_id = b.document_id AND a.service = b.service AND a.model = b.model
+    AND a.chunk_strategy = b.chunk_strategy AND a.chunk_size = b.chunk_size AND a.chunk_overlap = b.chunk_overlap;
+    """,
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS embedded_document_config_idx
+    ON embedded_document (document_id, service, model, chunk_strategy, chunk_size, chunk_overlap);
     """
 ]
 
 
-def create_tables(conn: Connection):
-    with conn.cursor() as cursor:
+async def create_tables(conn: Connection):
+    async with conn.transaction():
+        # Every API worker runs this on startup, concurrent CREATE ... IF NOT EXISTS can still collide.
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtextextended('create_tables', 0));")
         for sql in CREATE_TABLES_SQL:
-            cursor.execute(sql)
-    conn.commit()
+            await conn.execute(sql)
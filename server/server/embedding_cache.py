@@ -0,0 +1,85 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from server import metrics
+from server.embedding_models import is_local
+from server.local_embeddings import LocalBackend, get_local_variant
+from server.paths import DATA_PATH
+from server.schemas import Service, EmbeddingCacheStats
+
+embedding_cache_path = os.path.join(DATA_PATH, "embedding_cache.sqlite3")
+
+SQLITE_MAX_VARIABLES = 500
+
+local = threading.local()
+stats_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0}
+
+
+def get_cache_connection() -> sqlite3.Connection:
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(embedding_cache_path), exist_ok=True)
+        conn = sqlite3.connect(embedding_cache_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS embedding (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+        local.conn = conn
+    return conn
+
+
+def get_key(service: Service, model: str, text: str) -> bytes:
+    # Local vectors also depend on the backend and int8 setting. Plain torch keeps the key it always had, so the
+    # vectors cached before there were other backends are still found.
+    variant = get_local_variant(model) if is_local(service) else LocalBackend.torch.value
+    if variant != LocalBackend.torch.value:
+        return hashlib.sha256(f"{service.value}\0{model}\0{variant}\0{text}".encode()).digest()
+    return hashlib.sha256(f"{service.value}\0{model}\0{text}".encode()).digest()
+
+
+@metrics.timed
+def get_embeddings(service: Service, model: str, texts: list[str]) -> list[np.ndarray | None]:
+    keys = [get_key(service, model, text) for text in texts]
+    conn = get_cache_connection()
+    found: dict[bytes, np.ndarray] = {}
+    unique_keys = list(dict.fromkeys(keys))
+    for i in range(0, len(unique_keys), SQLITE_MAX_VARIABLES):
+        batch = unique_keys[i:i + SQLITE_MAX_VARIABLES]
+        rows = conn.execute(f"SELECT key, vector FROM embedding WHERE key IN ({','.join('?' * len(batch))})", batch)
+        found.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+
+    embeddings = [found.get(key) for key in keys]
+    hits = sum(embedding is not None for embedding in embeddings)
+    with stats_lock:
+        stats["hits"] += hits
+        stats["misses"] += len(embeddings) - hits
+    return embeddings
+
+
+@metrics.timed
+def put_embeddings(service: Service, model: str, texts: list[str], embeddings: np.ndarray):
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    rows = [(get_key(service, model, text), embedding.tobytes()) for text, embedding in zip(texts, embeddings)]
+    conn = get_cache_connection()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO embedding (key, vector) VALUES (?, ?)", rows)
+
+
+def get_cache_stats() -> EmbeddingCacheStats:
+    conn = get_cache_connection()
+    entries = conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+    with stats_lock:
+        return EmbeddingCacheStats(hits=stats["hits"], misses=stats["misses"], entries=entries)
+
+
+def collect_cache_metrics():
+    with stats_lock:
+        metrics.cache_hits.set_total(stats["hits"], "embedding")
+        metrics.cache_misses.set_total(stats["misses"], "embedding")
+
+
+metrics.collectors.append(collect_cache_metrics)
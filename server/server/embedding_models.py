@@ -1,21 +1,18 @@
 import os
-from enum import Enum
+import threading
 from typing import Callable
 
-import chromadb.utils.embedding_functions as embedding_functions
-
+from server.cache import LRUCache
+from server.local_embeddings import load_local_embedder
 from server.schemas import EmbeddingModel, Service
 
-
-class ModelConfig(str, Enum):
-    model_name = "model_name"
-    api_key = "api_key"
-
+# Local models keep their weights in memory, only the most recently used ones stay loaded.
+LOCAL_MODEL_CACHE_SIZE = int(os.getenv("LOCAL_MODEL_CACHE_SIZE") or 2)
 
 keys: dict[Service, str] = {
     Service.openAI: os.getenv("OPENAI_API_KEY") or "",
-    Service.google: os.getenv("COHERE_API_KEY") or "",
-    Service.cohere: os.getenv("GOOGLE_API_KEY") or ""
+    Service.google: os.getenv("GOOGLE_API_KEY") or "",
+    Service.cohere: os.getenv("COHERE_API_KEY") or ""
 }
 
 models: dict[Service, str] = {
@@ -25,32 +22,49 @@ models: dict[Service, str] = {
     Service.google: ""
 }
 
-functions: dict[Service, Callable] = {
-    Service.sentenceTransformers: embedding_functions.SentenceTransformerEmbeddingFunction,
-    Service.openAI: embedding_functions.OpenAIEmbeddingFunction,
-    Service.cohere: embedding_functions.CohereEmbeddingFunction,
-    Service.google: embedding_functions.GoogleGenerativeAiEmbeddingFunction
-}
 
+class EmbeddingFunctionRegistry:
+    # One warm instance per local model, shared by every caller in the process. Remote services are called through
+    # server.remote_embeddings and never come through here.
+    def __init__(self, max_local_models: int):
+        self._local = LRUCache(max_local_models, "local_embedding_model")
+        self._lock = threading.Lock()
+        self._loading: dict[tuple[Service, str], threading.Lock] = {}
 
-configs: dict[Service, list[ModelConfig]] = {
-    Service.sentenceTransformers: [],
-    Service.openAI: [ModelConfig.model_name, ModelConfig.api_key],
-    Service.cohere: [ModelConfig.model_name, ModelConfig.api_key],
-    Service.google: [ModelConfig.api_key]
-}
+    def get(self, service: Service, model: str) -> Callable:
+        if not is_local(service):
+            raise ValueError(f"{service.value} embeddings are not computed locally")
+        key = (service, model)
+        function = self._local.get(key)
+        if function is not None:
+            return function
+        # Loading happens under a lock per key, so a model is loaded once however many threads ask for it.
+        with self._lock:
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            function = self._local.get(key)
+            if function is None:
+                function = load_local_embedder(model)
+                self._local.put(key, function)
+        return function
 
-config_dicts: dict[ModelConfig, dict] = {
-    ModelConfig.api_key: keys,
-    ModelConfig.model_name: models
-}
+    def clear(self):
+        self._local.clear()
+
+
+registry = EmbeddingFunctionRegistry(LOCAL_MODEL_CACHE_SIZE)
 
 
 def get_embedding_function(service: Service, model: str = ""):
-    if model:
-        models[service] = model
-    kwargs = {c.value: config_dicts[c][service] for c in configs[service]}
-    return functions[service](**kwargs)
+    return registry.get(service, model or models[service])
+
+
+def embed_texts(service: Service, model: str, texts: list[str]):
+    return get_embedding_function(service, model)(texts)
+
+
+def is_local(service: Service) -> bool:
+    return service == Service.sentenceTransformers
 
 
 def need_api_key(service: Service) -> bool:
@@ -0,0 +1,62 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable
+
+# uvicorn starts this many API processes, each with its own executors and in-memory caches.
+API_WORKERS = int(os.getenv("WEB_CONCURRENCY") or 1)
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS") or 32)
+CPU_WORKERS = int(os.getenv("CPU_WORKERS") or max(1, (os.cpu_count() or 1) // API_WORKERS))
+
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+cpu_executor: ProcessPoolExecutor | None = None
+embedding_executor: ProcessPoolExecutor | None = None
+
+
+def get_cpu_executor() -> ProcessPoolExecutor:
+    global cpu_executor
+    if cpu_executor is None:
+        # Worker processes are spawned rather than forked so they don't inherit the
+        # server's threads, sockets and database connections.
+        cpu_executor = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return cpu_executor
+
+
+def get_embedding_executor() -> ProcessPoolExecutor:
+    global embedding_executor
+    if embedding_executor is None:
+        # Local models run in a single process of their own, so each API process holds their weights once instead of
+        # once per CPU worker.
+        embedding_executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return embedding_executor
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # The context travels along so spans recorded in the thread keep the request id.
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(blocking_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def run_cpu(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_executor(), functools.partial(func, *args, **kwargs))
+
+
+async def run_embedding(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_embedding_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executors():
+    global cpu_executor, embedding_executor
+    blocking_executor.shutdown(wait=False, cancel_futures=True)
+    if cpu_executor is not None:
+        cpu_executor.shutdown(wait=False, cancel_futures=True)
+        cpu_executor = None
+    if embedding_executor is not None:
+        embedding_executor.shutdown(wait=False, cancel_futures=True)
+        embedding_executor = None
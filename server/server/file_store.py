@@ -1,17 +1,91 @@
+import hashlib
 import os
+import re
+import uuid
+from typing import Optional
 
 import aiofiles
-from fastapi import File
+import anyio
+from fastapi import File, HTTPException
+from starlette.requests import Request
+from starlette.responses import FileResponse, JSONResponse, Response
+from starlette.types import Message, Receive, Scope, Send
+
+from server.schemas import Document
 
 file_store_path = "/files"
 
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES") or 100 * 1024 * 1024)
+# Room for the multipart boundaries and part headers around the file.
+MAX_UPLOAD_BODY_BYTES = MAX_UPLOAD_BYTES + 64 * 1024
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def get_upload_limit_error() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Files are limited to {MAX_UPLOAD_BYTES // (1024 * 1024)} MiB")
+
+
+class UploadLimitMiddleware:
+    # Starlette spools the whole multipart body to disk before the route runs, so oversized uploads are turned away
+    # here, on their Content-Length or once the streamed body goes over the limit.
+    def __init__(self, app, paths: set[str]):
+        self.app = app
+        self.paths = paths
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BODY_BYTES:
+            error = get_upload_limit_error()
+            await JSONResponse({"detail": error.detail}, status_code=error.status_code)(scope, receive, send)
+            return
 
-async def save_file(file: File):
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > MAX_UPLOAD_BODY_BYTES:
+                    raise get_upload_limit_error()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+async def receive_file(file: File) -> tuple[str, str, int]:
+    # The upload is hashed while it streams into a temporary file, which is stored under its hash once the document
+    # row exists, so identical files share one copy and two files with the same name never overwrite each other.
     os.makedirs(file_store_path, exist_ok=True)
-    file_path = os.path.join(file_store_path, file.filename)
-    async with aiofiles.open(file_path, 'wb') as out_file:
-        while content := await file.read(1024):
-            await out_file.write(content)
+    temp_path = os.path.join(file_store_path, f".upload-{uuid.uuid4()}")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(temp_path, 'wb') as out_file:
+            while content := await file.read(UPLOAD_BUFFER_SIZE):
+                size += len(content)
+                if size > MAX_UPLOAD_BYTES:
+                    raise get_upload_limit_error()
+                digest.update(content)
+                await out_file.write(content)
+    except BaseException:
+        discard_file(temp_path)
+        raise
+    return temp_path, digest.hexdigest(), size
+
+
+def store_file(temp_path: str, content_hash: str):
+    os.replace(temp_path, get_path(content_hash))
+
+
+def discard_file(temp_path: str):
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
 
 
 def delete_file(file: str):
@@ -21,3 +95,72 @@ def delete_file(file: str):
 
 def get_path(file_name: str):
     return os.path.join(file_store_path, file_name)
+
+
+def get_file_name(document: Document) -> str:
+    # Documents uploaded before the store was content addressed are still kept under their own name.
+    return document.content_hash or document.name
+
+
+def get_document_path(document: Document) -> str:
+    return get_path(get_file_name(document))
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    # Only single ranges are served, anything else gets the whole file.
+    match = RANGE_PATTERN.fullmatch(header.strip()) if header else None
+    if match is None or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+        if end < start and start < size:
+            return None
+    else:
+        start, end = max(size - int(end), 0), size - 1
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+class FileRangeResponse(Response):
+    def __init__(self, path: str, start: int, end: int, size: int, headers: dict[str, str], media_type: str):
+        super().__init__(status_code=206, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.end = end
+        self.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        self.headers["Content-Length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        remaining = self.end - self.start + 1
+        async with await anyio.open_file(self.path, mode="rb") as file:
+            await file.seek(self.start)
+            while remaining > 0:
+                chunk = await file.read(min(UPLOAD_BUFFER_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+def file_response(request: Request, document: Document, media_type: str) -> Response:
+    path = get_document_path(document)
+    size = os.stat(path).st_size
+    headers = {"Accept-Ranges": "bytes"}
+    if document.content_hash:
+        # The hash is a strong validator, so clients can revalidate and resume without a second look at the file.
+        headers["ETag"] = f'"{document.content_hash}"'
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+    if_range = request.headers.get("if-range")
+    byte_range = parse_range(request.headers.get("range"), size) \
+        if if_range is None or if_range == headers.get("ETag") else None
+    if byte_range is not None:
+        return FileRangeResponse(path, *byte_range, size, headers, media_type)
+    # Whole files go through FileResponse, which hands the path to the server for sendfile when it supports it.
+    return FileResponse(path=path, filename=document.name, media_type=media_type, headers=headers)
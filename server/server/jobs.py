@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+from typing import TYPE_CHECKING
+
+import numpy as np
+from asyncpg import Connection
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from server import chroma, crud, metrics, mongo, query_cache
+from server.db import get_pool
+from server.file_store import get_document_path
+from server.schemas import Playground, BuildStage, BuildStatus
+
+if TYPE_CHECKING:
+    from chromadb import ClientAPI
+
+logger = logging.getLogger(__name__)
+
+BUILD_WORKERS = int(os.getenv("BUILD_WORKERS") or 2)
+BUILD_QUEUE_SIZE = int(os.getenv("BUILD_QUEUE_SIZE") or 32)
+REFIT_DRIFT_THRESHOLD = float(os.getenv("REFIT_DRIFT_THRESHOLD") or 0.25)
+
+build_queue: asyncio.Queue | None = None
+workers: list[asyncio.Task] = []
+active_builds: set[str] = set()
+build_request_ids: dict[str, str] = {}
+clients: dict[str, ClientAPI | AsyncIOMotorClient] = {}
+
+
+async def embed_documents(conn: Connection, playground: Playground):
+    document_ids = await crud.read_playground_docs(conn, playground.id)
+    documents = await crud.read_docs(conn, document_ids)
+    for i, doc in enumerate(documents):
+        embedded_document_id = await crud.read_or_create_embedded_doc(conn, doc.id, playground.service.value,
+                                                                      playground.model, playground.chunking)
+        # Playgrounds share embedded documents, a build that needs one another build is embedding waits for it
+        # and then finds the finished collection.
+        lock_key = f"embedded_document:{embedded_document_id}"
+        await crud.lock(conn, lock_key)
+        try:
+            await chroma.embed_document(clients["chroma"], str(embedded_document_id), get_document_path(doc),
+                                        playground.service, playground.model, playground.chunking)
+        finally:
+            await crud.unlock(conn, lock_key)
+        await crud.update_build_stage(conn, playground.id, BuildStage.embedding, (i + 1) / len(documents))
+
+
+async def project_points(conn: Connection, playground: Playground):
+    collection_names = await crud.read_playground_collections(conn, playground.id)
+    build = await crud.read_build(conn, playground.id)
+    projection = None if build.refit else await mongo.get_projection(clients["mongo"], str(playground.id))
+    # A preview is in the randomized SVD's coordinates, new points can't be added to it in the final layout's.
+    if projection is not None and not projection.preview:
+        update = await chroma.update_playground_points(clients["chroma"], playground, collection_names, projection)
+        if update is not None:
+            ids, coordinates, changed_points = update
+            await mongo.save_projection(clients["mongo"], str(playground.id), ids, coordinates)
+            await crud.add_playground_drift(conn, playground.id, changed_points)
+            return
+
+    async def save_preview(preview_ids: list[str], preview_coordinates: np.ndarray):
+        # Only a first build shows a preview, a refit keeps serving the previous layout until the new one is in.
+        if not build.refit and (projection is None or projection.preview):
+            await mongo.save_projection(clients["mongo"], str(playground.id), preview_ids, preview_coordinates,
+                                        preview=True)
+
+    ids, coordinates = await chroma.create_playground_points(clients["chroma"], playground, collection_names,
+                                                             on_preview=save_preview)
+    await mongo.save_projection(clients["mongo"], str(playground.id), ids, coordinates)
+    await crud.reset_playground_drift(conn, playground.id, len(ids))
+    await reproject_queries(conn, playground, collection_names)
+
+
+async def reproject_queries(conn: Connection, playground: Playground, collection_names: list[str]):
+    # A new fit moves every point, so earlier queries are placed again. Their embeddings come from the cache.
+    queries, _ = await crud.read_queries(conn, playground.id)
+    if not queries:
+        return
+    embedded_queries = await query_cache.embed_queries(playground.service, playground.model,
+                                                       [query.text for query in queries])
+    query_points = await chroma.create_query_points(clients["chroma"], playground, collection_names,
+                                                    embedded_queries, [str(query.id) for query in queries])
+    await mongo.replace_query_points(clients["mongo"], str(playground.id), query_points)
+
+
+stage_handlers = {
+    BuildStage.embedding: embed_documents,
+    BuildStage.projection: project_points,
+}
+
+
+async def run_build(playground_id: str):
+    token = metrics.request_id.set(build_request_ids.pop(playground_id, None))
+    try:
+        with metrics.span("jobs.run_build"):
+            await run_build_stages(playground_id)
+    finally:
+        metrics.request_id.reset(token)
+
+
+def get_build_lock_key(playground_id: str) -> str:
+    return f"build:{playground_id}"
+
+
+async def is_building(conn: Connection, playground_id: str) -> bool:
+    # Builds queued in this process, or running in any process.
+    return playground_id in active_builds or await crud.is_locked(conn, get_build_lock_key(playground_id))
+
+
+async def run_build_stages(playground_id: str):
+    async with get_pool().acquire() as conn:
+        # Every API worker resumes pending builds on startup, the lock lets only one of them run each build.
+        if not await crud.try_lock(conn, get_build_lock_key(playground_id)):
+            logger.info(f"Playground {playground_id} is being built by another worker")
+            return
+        try:
+            await run_locked_build(conn, playground_id)
+        finally:
+            await crud.unlock(conn, get_build_lock_key(playground_id))
+
+
+async def run_locked_build(conn: Connection, playground_id: str):
+    try:
+        build = await crud.read_build(conn, playground_id)
+        if build is None or build.status not in (BuildStatus.queued, BuildStatus.running):
+            return
+        playground = (await crud.read_playgrounds(conn, [playground_id]))[0]
+        for stage, handler in stage_handlers.items():
+            if stage in build.completed_stages:
+                continue
+            await crud.update_build_stage(conn, playground.id, stage, 0)
+            with metrics.span(f"build.{stage.value}"):
+                await handler(conn, playground)
+            await crud.complete_build_stage(conn, playground.id, stage)
+        await crud.finish_build(conn, playground.id, BuildStatus.done)
+        # Results keyed on the new collections are already fresh, this only frees the ones that can't be hit anymore,
+        # and only in this process.
+        query_cache.invalidate_playground(str(playground.id))
+    except Exception as e:
+        logger.error(f"Failed to build playground {playground_id}: {e}")
+        await crud.finish_build(conn, playground_id, BuildStatus.failed, str(e))
+
+
+async def worker():
+    while True:
+        playground_id = await build_queue.get()
+        try:
+            await run_build(playground_id)
+        except Exception as e:
+            logger.error(f"Build worker failed on playground {playground_id}: {e}")
+        finally:
+            active_builds.discard(playground_id)
+            build_queue.task_done()
+
+
+def submit_build(playground_id: str) -> bool:
+    if playground_id in active_builds:
+        return False
+    build_queue.put_nowait(playground_id)
+    active_builds.add(playground_id)
+    if metrics.request_id.get():
+        build_request_ids[playground_id] = metrics.request_id.get()
+    return True
+
+
+async def start_workers(chroma_client: ClientAPI, mongo_client: AsyncIOMotorClient):
+    global build_queue
+    clients["chroma"] = chroma_client
+    clients["mongo"] = mongo_client
+    build_queue = asyncio.Queue(maxsize=BUILD_QUEUE_SIZE)
+    workers.extend(asyncio.create_task(worker()) for _ in range(BUILD_WORKERS))
+
+    async with get_pool().acquire() as conn:
+        pending_builds = await crud.read_pending_builds(conn)
+    for build in pending_builds:
+        try:
+            submit_build(str(build.playground_id))
+        except asyncio.QueueFull:
+            logger.error(f"Build queue is full, playground {build.playground_id} will resume on request")
+
+
+async def stop_workers():
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+
+
+def collect_build_metrics():
+    metrics.build_queue_depth.set(build_queue.qsize() if build_queue is not None else 0)
+    metrics.active_builds.set(len(active_builds))
+
+
+metrics.collectors.append(collect_build_metrics)
@@ -0,0 +1,123 @@
+import functools
+import importlib.util
+import logging
+import os
+import threading
+from enum import Enum
+
+import numpy as np
+
+from server.executors import CPU_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBackend(str, Enum):
+    torch = "torch"
+    onnx = "onnx"
+
+
+LOCAL_EMBEDDING_BACKEND = LocalBackend(os.getenv("LOCAL_EMBEDDING_BACKEND") or LocalBackend.torch)
+LOCAL_EMBEDDING_INT8 = (os.getenv("LOCAL_EMBEDDING_INT8") or "false").lower() == "true"
+# Local models run in the one embedding worker of each API process, by default with a thread for each of the cores
+# that process' CPU workers get.
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS") or CPU_WORKERS)
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE") or 64)
+LOCAL_EMBEDDING_MAX_TOKENS = 256
+
+# chromadb only ships an ONNX export of its default model, other models stay on torch.
+ONNX_MODELS = {"all-MiniLM-L6-v2"}
+
+
+class TorchEmbedder:
+    def __init__(self, model: str, int8: bool, threads: int, batch_size: int):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(threads)
+        self.model = SentenceTransformer(model, device="cpu")
+        if int8:
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        # Concurrent encodes would only compete for the same threads.
+        with self.lock:
+            return self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+
+
+class OnnxEmbedder:
+    def __init__(self, model: str, int8: bool, threads: int, batch_size: int):
+        import onnxruntime
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+        from tokenizers import Tokenizer
+
+        onnx_function = ONNXMiniLM_L6_V2()
+        onnx_function._download_model_if_not_exists()
+        model_dir = os.path.join(ONNXMiniLM_L6_V2.DOWNLOAD_PATH, ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=LOCAL_EMBEDDING_MAX_TOKENS)
+        # Batches are padded to their longest text rather than to the maximum length like chromadb does.
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_path = os.path.join(model_dir, "model.onnx")
+        if int8:
+            model_path = quantize_onnx_model(model_path)
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.batch_size = batch_size
+
+    def encode_batch(self, texts: list[str]) -> np.ndarray:
+        encoded = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        hidden_state = self.session.run(None, {"input_ids": input_ids, "attention_mask": attention_mask,
+                                               "token_type_ids": np.zeros_like(input_ids)})[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        embeddings = (hidden_state * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        # Texts of similar length are batched together so little of each batch is padding.
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        order = np.argsort([len(text) for text in texts], kind="stable")
+        batches = [self.encode_batch([texts[i] for i in order[start:start + self.batch_size]])
+                   for start in range(0, len(texts), self.batch_size)]
+        embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.concatenate(batches)
+        return embeddings
+
+
+def quantize_onnx_model(model_path: str) -> str:
+    quantized_path = model_path.replace(".onnx", ".int8.onnx")
+    if not os.path.exists(quantized_path):
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+        except ImportError:
+            logger.warning("onnxruntime quantization needs the onnx package, using the float32 model")
+            return model_path
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+@functools.lru_cache
+def get_local_variant(model: str) -> str:
+    # Which backend and weights actually encode the model, the vectors of two variants differ slightly.
+    onnx = LOCAL_EMBEDDING_BACKEND == LocalBackend.onnx and model in ONNX_MODELS
+    int8 = LOCAL_EMBEDDING_INT8 and (not onnx or importlib.util.find_spec("onnx") is not None)
+    backend = LocalBackend.onnx if onnx else LocalBackend.torch
+    return f"{backend.value}-int8" if int8 else backend.value
+
+
+def load_local_embedder(model: str, backend: LocalBackend = LOCAL_EMBEDDING_BACKEND, int8: bool = LOCAL_EMBEDDING_INT8,
+                        threads: int = LOCAL_EMBEDDING_THREADS, batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE):
+    if backend == LocalBackend.onnx and model in ONNX_MODELS:
+        return OnnxEmbedder(model, int8, threads, batch_size)
+    if backend == LocalBackend.onnx:
+        logger.warning(f"No ONNX export of {model}, loading it with torch")
+    return TorchEmbedder(model, int8, threads, batch_size)
@@ -1,12 +1,19 @@
+import os
+
 import uvicorn
 
+# The same variable uvicorn's command line reads, so the API processes can see how many of them there are.
+WORKERS = int(os.getenv("WEB_CONCURRENCY") or 1)
+
 
 def main():
     uvicorn.run(
         "server.api:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        # Reloading only works with a single process.
+        reload=WORKERS == 1,
+        workers=WORKERS
     )
 
 
@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+TRACING = (os.getenv("TRACING") or "false").lower() == "true"
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+logger = logging.getLogger(__name__)
+
+# Set per API request and carried over to the background builds it queues, so spans of both share it.
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+        metrics.append(self)
+
+    def samples(self) -> list[tuple[str, tuple[tuple[str, str], ...], float]]:
+        with self._lock:
+            return [(self.name, tuple(zip(self.label_names, labels)), value) for labels, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_total(self, value: float, *labels: str):
+        # For totals counted elsewhere and copied in by a collector.
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DURATION_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = buckets
+        self._observations: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts, total = self._observations.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            total[0] += value
+
+    def samples(self) -> list[tuple[str, tuple[tuple[str, str], ...], float]]:
+        samples = []
+        with self._lock:
+            for labels, (counts, total) in self._observations.items():
+                label_pairs = tuple(zip(self.label_names, labels))
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", label_pairs + (("le", str(bound)),), count))
+                samples.append((f"{self.name}_bucket", label_pairs + (("le", "+Inf"),), counts[-1]))
+                samples.append((f"{self.name}_sum", label_pairs, total[0]))
+                samples.append((f"{self.name}_count", label_pairs, counts[-1]))
+        return samples
+
+
+metrics: list[Metric] = []
+collectors: list[Callable[[], None]] = []
+
+stage_duration = Histogram("stage_duration_seconds", "Duration of data layer and pipeline stages", ("stage",))
+http_request_duration = Histogram("http_request_duration_seconds", "Duration of API requests",
+                                  ("method", "route", "status"))
+embedded_texts = Counter("embedded_texts_total", "Texts sent to an embedding model", ("service", "model"))
+embedding_requests = Counter("embedding_requests_total", "Requests to remote embedding providers",
+                             ("service", "model", "status"))
+embedding_tokens = Counter("embedding_tokens_total", "Tokens billed by remote embedding providers",
+                           ("service", "model"))
+cache_hits = Counter("cache_hits_total", "Lookups answered from a cache", ("cache",))
+cache_misses = Counter("cache_misses_total", "Lookups a cache could not answer", ("cache",))
+cache_entries = Gauge("cache_entries", "Entries held by a cache", ("cache",))
+db_pool_connections = Gauge("db_pool_connections", "Postgres pool connections", ("state",))
+build_queue_depth = Gauge("build_queue_depth", "Playground builds waiting for a worker")
+active_builds = Gauge("active_builds", "Playground builds queued or running")
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def render() -> str:
+    for collect in collectors:
+        try:
+            collect()
+        except Exception as e:
+            logger.error(f"Metrics collector {collect.__name__} failed: {e}")
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(f"{name}{format_labels(labels)} {value}" for name, labels, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        stage_duration.observe(duration, stage)
+        if TRACING:
+            logger.info(f"span stage={stage} request_id={request_id.get()} duration={duration:.6f}")
+
+
+def timed(func: Callable) -> Callable:
+    stage = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with span(stage):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(stage):
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,12 +1,26 @@
 import os
+import time
+from typing import Optional
 
-from bson import ObjectId
+import numpy as np
+from bson import Binary
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from server.cache import LRUCache
+from server.executors import API_WORKERS
+from server.metrics import timed
+from server.points_codec import Projection, uuid_bytes
 from server.schemas import Point
 
 DB_NAME = "points"
 
+PROJECTION_CHUNK_POINTS = 65536
+
+projection_cache = LRUCache(int(os.getenv("PROJECTION_CACHE_SIZE") or 16), "projection")
+
+
+mongo_client: Optional[AsyncIOMotorClient] = None
+
 
 def get_mongo_client():
     user = os.getenv("POINTSTORE_USER")
@@ -17,32 +31,128 @@ def get_mongo_client():
     return client
 
 
-async def create_points_collection(client: AsyncIOMotorClient, playground_id: str, points: list[Point]):
+def get_client() -> AsyncIOMotorClient:
+    global mongo_client
+    if mongo_client is None:
+        mongo_client = get_mongo_client()
+    return mongo_client
+
+
+@timed
+async def save_projection(client: AsyncIOMotorClient, playground_id: str, ids: list[str],
+                          coordinates: np.ndarray, preview: bool = False) -> Projection:
+    projection = Projection(version=time.time_ns(), ids=uuid_bytes(ids),
+                            coordinates=np.ascontiguousarray(coordinates, dtype="<f4"), preview=preview)
+    starts = range(0, max(len(ids), 1), PROJECTION_CHUNK_POINTS)
+    documents = [
+        {
+            "playground_id": playground_id,
+            "version": projection.version,
+            "seq": seq,
+            "chunks": len(starts),
+            "dimensions": projection.coordinates.shape[1],
+            "preview": preview,
+            "ids": Binary(projection.ids[start:start + PROJECTION_CHUNK_POINTS].tobytes()),
+            "coordinates": Binary(projection.coordinates[start:start + PROJECTION_CHUNK_POINTS].tobytes()),
+        }
+        for seq, start in enumerate(starts)
+    ]
+    collection = client[DB_NAME]["projections"]
+    await collection.insert_many(documents)
+    await collection.delete_many({"playground_id": playground_id, "version": {"$lt": projection.version}})
+    projection_cache.put(playground_id, projection)
+    return projection
+
+
+def decode_projection(documents: list[dict]) -> Projection:
+    ids = np.frombuffer(b"".join(document["ids"] for document in documents), dtype=np.uint8).reshape(-1, 16)
+    coordinates = np.frombuffer(b"".join(document["coordinates"] for document in documents), dtype="<f4")
+    return Projection(version=documents[0]["version"], ids=ids,
+                      coordinates=coordinates.reshape(-1, documents[0]["dimensions"]),
+                      preview=documents[0].get("preview", False))
+
+
+@timed
+async def has_newer_projection(client: AsyncIOMotorClient, projection: Projection, playground_id: str) -> bool:
+    # Other workers save projections too, a cached one is checked against the newest version before it's served.
+    newer = await client[DB_NAME]["projections"].find_one(
+        {"playground_id": playground_id, "version": {"$gt": projection.version}}, {"_id": 1})
+    return newer is not None
+
+
+@timed
+async def get_projection(client: AsyncIOMotorClient, playground_id: str) -> Optional[Projection]:
+    projection = projection_cache.get(playground_id)
+    if projection is not None and (API_WORKERS == 1 or not await has_newer_projection(client, projection,
+                                                                                      playground_id)):
+        return projection
+
+    cursor = client[DB_NAME]["projections"].find({"playground_id": playground_id}).sort([("version", -1), ("seq", 1)])
+    versions: dict[int, list[dict]] = {}
+    for document in await cursor.to_list(length=None):
+        versions.setdefault(document["version"], []).append(document)
+    # A version whose chunks are still being written is skipped in favour of the previous complete one.
+    for documents in versions.values():
+        if len(documents) == documents[0]["chunks"]:
+            projection = decode_projection(documents)
+            projection_cache.put(playground_id, projection)
+            return projection
+
+    return await migrate_points_collection(client, playground_id)
+
+
+@timed
+async def migrate_points_collection(client: AsyncIOMotorClient, playground_id: str) -> Optional[Projection]:
+    # Older builds stored one document per point in a collection named after the playground.
     collection = client[DB_NAME][playground_id]
-    mongo_points = [{**point.dict(exclude={"id"}), "_id": str(point.id)} for point in points]
-    result = await collection.insert_many(mongo_points)
-    return result.inserted_ids
+    documents = await collection.find().to_list(length=None)
+    if not documents:
+        return None
+    coordinates = np.array([(document["x"], document["y"], document.get("z", 0)) for document in documents])
+    projection = await save_projection(client, playground_id, [document["_id"] for document in documents],
+                                       coordinates)
+    await collection.drop()
+    return projection
 
 
-async def get_points(client: AsyncIOMotorClient, collection_name: str) -> list[Point]:
-    collection = client[DB_NAME][collection_name]
-    points = []
-    async for document in collection.find():
-        point = Point(id=document["_id"], x=document["x"], y=document["y"], z=0)
-        points.append(point)
+@timed
+async def delete_projection(client: AsyncIOMotorClient, playground_id: str):
+    projection_cache.pop(playground_id)
+    await client[DB_NAME]["projections"].delete_many({"playground_id": playground_id})
+    await client[DB_NAME][playground_id].drop()
 
-    return points
+
+@timed
+async def create_indexes(client: AsyncIOMotorClient):
+    await client[DB_NAME]["queries"].create_index("playground_id")
+    await client[DB_NAME]["projections"].create_index([("playground_id", 1), ("version", -1), ("seq", 1)])
 
 
-async def insert_query_point(client: AsyncIOMotorClient, point: Point) -> Point:
+@timed
+async def insert_query_points(client: AsyncIOMotorClient, playground_id: str, points: list[Point]):
     collection = client[DB_NAME]["queries"]
-    mongo_point = {**point.dict(exclude={"id"}), "_id": str(point.id)}
-    result = await collection.insert_one(mongo_point)
-    return result.inserted_id
+    mongo_points = [{**point.dict(exclude={"id"}), "_id": str(point.id), "playground_id": playground_id}
+                    for point in points]
+    result = await collection.insert_many(mongo_points)
+    return result.inserted_ids
+
+
+@timed
+async def replace_query_points(client: AsyncIOMotorClient, playground_id: str, points: list[Point]):
+    await delete_query_points(client, playground_id)
+    if points:
+        await insert_query_points(client, playground_id, points)
 
 
-async def get_mongo_query_point(client: AsyncIOMotorClient, query_id: str) -> Point:
+@timed
+async def get_query_points(client: AsyncIOMotorClient, query_ids: list[str]) -> dict[str, Point]:
     collection = client[DB_NAME]["queries"]
-    document = await collection.find_one({'_id': query_id})
-    del document['_id']
-    return Point(**document, id=query_id)
+    points = {}
+    async for document in collection.find({"_id": {"$in": query_ids}}):
+        points[document["_id"]] = Point(id=document["_id"], x=document["x"], y=document["y"], z=document["z"])
+    return points
+
+
+@timed
+async def delete_query_points(client: AsyncIOMotorClient, playground_id: str):
+    await client[DB_NAME]["queries"].delete_many({"playground_id": playground_id})
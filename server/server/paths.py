@@ -0,0 +1,5 @@
+import os
+
+# Files the API writes next to the stores: the embedding cache, UMAP models and kNN graphs. Every API worker has to
+# see the same directory, and it shouldn't be the volume of a separate Chroma server.
+DATA_PATH = os.getenv("DATA_PATH") or "/chroma_path"
@@ -0,0 +1,96 @@
+import gzip
+import struct
+import uuid
+from typing import NamedTuple
+
+import numpy as np
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from server.schemas import Point
+
+POINTS_MEDIA_TYPE = "application/vnd.embeddings-playground.points"
+
+# Payload layout, all little endian:
+#   magic "EPPT", uint16 version, uint16 dimensions, uint32 point count,
+#   float32[count][dimensions] coordinates,
+#   16-byte raw UUIDs, one per point, in the same order as the coordinates.
+MAGIC = b"EPPT"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+
+COMPRESSION_MIN_BYTES = 1024
+
+
+class Projection(NamedTuple):
+    version: int
+    ids: np.ndarray
+    coordinates: np.ndarray
+    preview: bool = False
+
+
+def uuid_bytes(ids: list[str]) -> np.ndarray:
+    return np.frombuffer(b"".join(uuid.UUID(str(point_id)).bytes for point_id in ids), dtype=np.uint8).reshape(-1, 16)
+
+
+def projection_to_points(projection: Projection) -> list[Point]:
+    coordinates = np.zeros((len(projection.coordinates), 3), dtype=np.float32)
+    coordinates[:, :projection.coordinates.shape[1]] = projection.coordinates[:, :3]
+    return [
+        Point.model_construct(id=uuid.UUID(bytes=point_id.tobytes()), x=x, y=y, z=z)
+        for point_id, (x, y, z) in zip(projection.ids, coordinates.tolist())
+    ]
+
+
+def encode_points(ids: np.ndarray, coordinates: np.ndarray) -> bytes:
+    coordinates = np.ascontiguousarray(coordinates, dtype="<f4")
+    header = HEADER.pack(MAGIC, VERSION, coordinates.shape[1], coordinates.shape[0])
+    return header + coordinates.tobytes() + np.ascontiguousarray(ids, dtype=np.uint8).tobytes()
+
+
+def decode_points(payload: bytes) -> tuple[list[uuid.UUID], np.ndarray]:
+    magic, version, dimensions, count = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a points payload")
+    offset = HEADER.size
+    coordinates = np.frombuffer(payload, dtype="<f4", count=count * dimensions, offset=offset)
+    offset += coordinates.nbytes
+    ids = [uuid.UUID(bytes=payload[offset + 16 * i:offset + 16 * (i + 1)]) for i in range(count)]
+    return ids, coordinates.reshape(count, dimensions)
+
+
+def get_etag(projection: Projection) -> str:
+    return f'"{projection.version}"'
+
+
+def accepts_media_type(request: Request, media_type: str) -> bool:
+    return any(accepted.split(";")[0].strip() == media_type
+               for accepted in request.headers.get("accept", "").split(","))
+
+
+def compress(payload: bytes, accept_encoding: str) -> tuple[bytes, str | None]:
+    encodings = {encoding.split(";")[0].strip() for encoding in accept_encoding.split(",")}
+    if len(payload) < COMPRESSION_MIN_BYTES:
+        return payload, None
+    if zstandard is not None and "zstd" in encodings:
+        return zstandard.ZstdCompressor(level=3).compress(payload), "zstd"
+    if "gzip" in encodings:
+        return gzip.compress(payload, compresslevel=5), "gzip"
+    return payload, None
+
+
+def points_response(request: Request, projection: Projection, headers: dict[str, str] = None) -> Response:
+    headers = {**(headers or {}), "ETag": get_etag(projection), "Vary": "Accept, Accept-Encoding"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    payload = encode_points(projection.ids, projection.coordinates)
+    body, encoding = compress(payload, request.headers.get("accept-encoding", ""))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=POINTS_MEDIA_TYPE, headers=headers)
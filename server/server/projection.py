@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import os
+import uuid
+import warnings
+from typing import NamedTuple, TYPE_CHECKING
+
+import numpy as np
+
+from server.schemas import ProjectionConfig, ProjectionMethod
+
+if TYPE_CHECKING:
+    from sklearn.decomposition import PCA
+
+# umap compiles its numba code when it's imported, which takes seconds, so umap and sklearn are only imported by
+# the fits and transforms that need them, mostly inside the CPU workers.
+
+UMAP_PCA_DIMENSIONS = 50
+KNN_NEIGHBORS = int(os.getenv("KNN_NEIGHBORS") or 15)
+
+
+class KNNGraph(NamedTuple):
+    ids: np.ndarray
+    indices: np.ndarray
+    distances: np.ndarray
+
+
+def as_matrix(embeddings) -> np.ndarray:
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def fit_pca(embeddings: np.ndarray, dimensions: int, svd_solver: str) -> PCA:
+    from sklearn.decomposition import PCA
+    n_components = min(dimensions, *embeddings.shape)
+    return PCA(n_components=n_components, svd_solver=svd_solver, random_state=0).fit(embeddings)
+
+
+def pad_columns(coordinates: np.ndarray, dimensions: int) -> np.ndarray:
+    # PCA can't return more components than there are samples or features, tiny playgrounds get zero columns.
+    coordinates = as_matrix(coordinates)
+    if coordinates.shape[1] >= dimensions:
+        return coordinates
+    return np.pad(coordinates, ((0, 0), (0, dimensions - coordinates.shape[1])))
+
+
+class LinearProjection:
+    def __init__(self, embeddings: np.ndarray, dimensions: int, svd_solver: str):
+        self.dimensions = dimensions
+        self.pca = fit_pca(embeddings, dimensions, svd_solver)
+        self.embedding_ = self.transform(embeddings)
+
+    def transform(self, embeddings) -> np.ndarray:
+        return pad_columns(self.pca.transform(as_matrix(embeddings)), self.dimensions)
+
+
+class ReducedUMAP:
+    def __init__(self, embeddings: np.ndarray, dimensions: int):
+        import umap
+        self.pca = fit_pca(embeddings, UMAP_PCA_DIMENSIONS, "randomized") \
+            if embeddings.shape[1] > UMAP_PCA_DIMENSIONS else None
+        self.umap = umap.UMAP(n_components=dimensions, random_state=0, transform_seed=0).fit(self.reduce(embeddings))
+        self.embedding_ = self.umap.embedding_
+
+    def reduce(self, embeddings) -> np.ndarray:
+        embeddings = as_matrix(embeddings)
+        return as_matrix(self.pca.transform(embeddings)) if self.pca is not None else embeddings
+
+    def transform(self, embeddings) -> np.ndarray:
+        return self.umap.transform(self.reduce(embeddings))
+
+
+class NeighbourUMAP:
+    # UMAP fitted on a precomputed kNN graph has no search index to transform new vectors with, so they are
+    # placed at the distance weighted mean of their nearest fitted neighbours instead. Only the layout is kept,
+    # not UMAP's copy of the input vectors.
+    # Models pickled before the fitted collections were kept have none, they search every collection until the
+    # next change to the playground refits them.
+    collections: frozenset[str] = frozenset()
+
+    def __init__(self, embeddings: np.ndarray, config: ProjectionConfig, knn_graph: KNNGraph,
+                 collection_names: list[str] = ()):
+        import umap
+        if config.method == ProjectionMethod.umap:
+            params = {"random_state": 0, "transform_seed": 0}
+        else:
+            params = {"n_jobs": -1}
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=".*knn_search_index.*")
+            # n_neighbors has to match the graph, umap otherwise truncates it or runs its own search instead.
+            fitted = umap.UMAP(n_components=config.dimensions, n_neighbors=knn_graph.indices.shape[1],
+                               precomputed_knn=(knn_graph.indices, knn_graph.distances), **params).fit(embeddings)
+        self.embedding_ = as_matrix(fitted.embedding_)
+        self.rows = {point_id.tobytes(): row for row, point_id in enumerate(knn_graph.ids)}
+        # Collections are never changed once embedded, so every chunk of these has a row in the layout.
+        self.collections = frozenset(collection_names)
+
+    def place(self, neighbour_ids: list[list[str]], neighbour_distances: list[list[float]]) -> np.ndarray:
+        placed = np.empty((len(neighbour_ids), self.embedding_.shape[1]), dtype=np.float32)
+        for i, (ids, distances) in enumerate(zip(neighbour_ids, neighbour_distances)):
+            rows = [self.rows.get(uuid.UUID(point_id).bytes) for point_id in ids]
+            neighbours = [(row, distance) for row, distance in zip(rows, distances) if row is not None]
+            if not neighbours:
+                raise ValueError("Cannot place a vector without neighbours in the fitted layout")
+            rows, distances = zip(*neighbours)
+            weights = 1 / (np.array(distances, dtype=np.float32) + 1e-6)
+            placed[i] = weights @ self.embedding_[list(rows)] / weights.sum()
+        return placed
+
+
+def uses_knn_graph(config: ProjectionConfig) -> bool:
+    # The graph holds neighbours in the full embedding space, which the PCA reduced UMAP doesn't work in.
+    return config.method in (ProjectionMethod.umap, ProjectionMethod.umap_parallel)
+
+
+def fit_projection(embeddings, config: ProjectionConfig, knn_graph: KNNGraph = None, collection_names: list[str] = ()):
+    embeddings = as_matrix(embeddings)
+    if knn_graph is not None and uses_knn_graph(config) and len(embeddings) > KNN_NEIGHBORS:
+        return NeighbourUMAP(embeddings, config, knn_graph, collection_names)
+    if config.method == ProjectionMethod.pca:
+        return LinearProjection(embeddings, config.dimensions, "full")
+    if config.method == ProjectionMethod.randomized_svd:
+        return LinearProjection(embeddings, config.dimensions, "randomized")
+    if config.method == ProjectionMethod.umap_pca:
+        return ReducedUMAP(embeddings, config.dimensions)
+    import umap
+    if config.method == ProjectionMethod.umap_parallel:
+        # Without a random state UMAP is free to use every core, at the cost of a layout that differs per fit.
+        return umap.UMAP(n_components=config.dimensions, n_jobs=-1).fit(embeddings)
+    return umap.UMAP(n_components=config.dimensions, random_state=0, transform_seed=0).fit(embeddings)
+
+
+def has_preview(config: ProjectionConfig) -> bool:
+    return config.method not in (ProjectionMethod.pca, ProjectionMethod.randomized_svd)
+
+
+def get_preview_config(config: ProjectionConfig) -> ProjectionConfig:
+    return ProjectionConfig(method=ProjectionMethod.randomized_svd, dimensions=config.dimensions)
+
+
+def project_embeddings(embeddings, projection_model) -> np.ndarray:
+    return as_matrix(projection_model.transform(as_matrix(embeddings)))
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import unicodedata
+from typing import Optional, TYPE_CHECKING
+
+import numpy as np
+
+from server import chroma
+from server.cache import LRUCache
+from server.projection import as_matrix
+from server.schemas import Service
+
+if TYPE_CHECKING:
+    from chromadb import ClientAPI
+
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE") or 4096)
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS") or 3600)
+
+# Keyed on (service, model, normalized text), in front of the embedding cache so repeated questions skip the disk.
+query_embeddings = LRUCache(QUERY_CACHE_SIZE, "query_embedding", ttl=QUERY_CACHE_TTL_SECONDS)
+# Keyed on (playground, collections, embedding hash, k). The collections are the playground's embedded documents,
+# so adding or removing a document changes the key even in workers that never saw the change.
+query_results = LRUCache(QUERY_CACHE_SIZE, "query_result", ttl=QUERY_CACHE_TTL_SECONDS)
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def get_embedding_hash(embedding: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(embedding, dtype=np.float32).tobytes()).hexdigest()
+
+
+async def embed_queries(service: Service, model: str, texts: list[str]) -> np.ndarray:
+    keys = [(service.value, model, normalize_query(text)) for text in texts]
+    embeddings: list[Optional[np.ndarray]] = [query_embeddings.get(key) for key in keys]
+    missing_keys = list(dict.fromkeys(key for key, embedding in zip(keys, embeddings) if embedding is None))
+    if missing_keys:
+        new_embeddings = await chroma.embed(service, model, [key[2] for key in missing_keys])
+        for key, embedding in zip(missing_keys, new_embeddings):
+            query_embeddings.put(key, embedding)
+        embedded = dict(zip(missing_keys, new_embeddings))
+        embeddings = [embedded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+    return as_matrix(embeddings)
+
+
+async def get_query_results(client: ClientAPI, playground_id: str, collection_names: list[str],
+                            embedded_queries: np.ndarray, n_results: int = 5) -> list[list[str]]:
+    collections_key = tuple(sorted(collection_names))
+    keys = [(playground_id, collections_key, get_embedding_hash(embedding), n_results)
+            for embedding in embedded_queries]
+    results: list[Optional[list[str]]] = [query_results.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        new_results = await chroma.get_query_results(client, collection_names, embedded_queries[missing], n_results)
+        for i, result in zip(missing, new_results):
+            query_results.put(keys[i], result)
+            results[i] = result
+    return [list(result) for result in results]
+
+
+# Only drops this process' entries. Other API workers never need it for correctness, a result can only change with
+# the playground's collections and those are part of the key, their stale entries just wait for the LRU or the TTL.
+def invalidate_playground(playground_id: str) -> int:
+    return query_results.pop_where(lambda key: key[0] == playground_id)
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, Optional
+
+import aiohttp
+from fastapi import HTTPException
+
+from server import metrics
+from server.embedding_models import keys
+from server.schemas import Service
+
+base_urls: dict[Service, str] = {
+    Service.openAI: os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1",
+    Service.cohere: os.getenv("COHERE_BASE_URL") or "https://api.cohere.ai/v1",
+    Service.google: os.getenv("GOOGLE_BASE_URL") or "https://generativelanguage.googleapis.com/v1beta",
+}
+
+batch_sizes: dict[Service, int] = {
+    Service.openAI: int(os.getenv("OPENAI_BATCH_SIZE") or 512),
+    Service.cohere: int(os.getenv("COHERE_BATCH_SIZE") or 96),
+    Service.google: int(os.getenv("GOOGLE_BATCH_SIZE") or 100),
+}
+
+requests_per_second: dict[Service, float] = {
+    Service.openAI: float(os.getenv("OPENAI_REQUESTS_PER_SECOND") or 50),
+    Service.cohere: float(os.getenv("COHERE_REQUESTS_PER_SECOND") or 10),
+    Service.google: float(os.getenv("GOOGLE_REQUESTS_PER_SECOND") or 25),
+}
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("EMBEDDING_MAX_CONCURRENT_REQUESTS") or 4)
+MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES") or 6)
+BACKOFF_BASE_SECONDS = float(os.getenv("EMBEDDING_BACKOFF_BASE_SECONDS") or 0.5)
+BACKOFF_MAX_SECONDS = float(os.getenv("EMBEDDING_BACKOFF_MAX_SECONDS") or 30)
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("EMBEDDING_REQUEST_TIMEOUT_SECONDS") or 60)
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def openai_request(model: str, texts: list[str]) -> tuple[str, dict, dict]:
+    headers = {"Authorization": f"Bearer {keys[Service.openAI]}"}
+    return f"{base_urls[Service.openAI]}/embeddings", headers, {"model": model, "input": texts}
+
+
+def openai_response(body: dict) -> list[list[float]]:
+    return [item["embedding"] for item in sorted(body["data"], key=lambda item: item["index"])]
+
+
+def cohere_request(model: str, texts: list[str]) -> tuple[str, dict, dict]:
+    headers = {"Authorization": f"Bearer {keys[Service.cohere]}"}
+    return f"{base_urls[Service.cohere]}/embed", headers, {"model": model, "texts": texts,
+                                                           "input_type": "search_document"}
+
+
+def cohere_response(body: dict) -> list[list[float]]:
+    return body["embeddings"]
+
+
+def google_request(model: str, texts: list[str]) -> tuple[str, dict, dict]:
+    model = f"models/{model or 'embedding-001'}"
+    headers = {"x-goog-api-key": keys[Service.google]}
+    requests = [{"model": model, "content": {"parts": [{"text": text}]}} for text in texts]
+    return f"{base_urls[Service.google]}/{model}:batchEmbedContents", headers, {"requests": requests}
+
+
+def google_response(body: dict) -> list[list[float]]:
+    return [embedding["values"] for embedding in body["embeddings"]]
+
+
+request_builders: dict[Service, Callable[[str, list[str]], tuple[str, dict, dict]]] = {
+    Service.openAI: openai_request,
+    Service.cohere: cohere_request,
+    Service.google: google_request,
+}
+
+response_parsers: dict[Service, Callable[[dict], list[list[float]]]] = {
+    Service.openAI: openai_response,
+    Service.cohere: cohere_response,
+    Service.google: google_response,
+}
+
+
+def openai_tokens(body: dict) -> int:
+    return body.get("usage", {}).get("total_tokens", 0)
+
+
+def cohere_tokens(body: dict) -> int:
+    return body.get("meta", {}).get("billed_units", {}).get("input_tokens", 0)
+
+
+def google_tokens(body: dict) -> int:
+    # batchEmbedContents doesn't report usage.
+    return 0
+
+
+token_counters: dict[Service, Callable[[dict], int]] = {
+    Service.openAI: openai_tokens,
+    Service.cohere: cohere_tokens,
+    Service.google: google_tokens,
+}
+
+session: Optional[aiohttp.ClientSession] = None
+semaphores: dict[Service, asyncio.Semaphore] = {}
+buckets: dict[Service, TokenBucket] = {}
+
+
+def get_session() -> aiohttp.ClientSession:
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS))
+    return session
+
+
+async def close_session():
+    global session
+    if session is not None:
+        await session.close()
+    session = None
+    # Semaphores and buckets belong to the event loop they were first used on.
+    semaphores.clear()
+    buckets.clear()
+
+
+def get_semaphore(service: Service) -> asyncio.Semaphore:
+    if service not in semaphores:
+        semaphores[service] = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return semaphores[service]
+
+
+def get_bucket(service: Service) -> TokenBucket:
+    if service not in buckets:
+        buckets[service] = TokenBucket(requests_per_second[service])
+    return buckets[service]
+
+
+def get_backoff(attempt: int, retry_after: Optional[float]) -> float:
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX_SECONDS)
+    # Full jitter keeps concurrent batches that failed together from retrying together.
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+async def post_batch(service: Service, model: str, texts: list[str]) -> list[list[float]]:
+    url, headers, payload = request_builders[service](model, texts)
+    async with get_session().post(url, headers=headers, json=payload) as response:
+        metrics.embedding_requests.inc(service.value, model, str(response.status))
+        if response.status in RETRYABLE_STATUSES:
+            raise RetryableError(f"{service.value} returned {response.status}",
+                                 parse_retry_after(response.headers.get("Retry-After")))
+        if response.status >= 400:
+            raise HTTPException(status_code=502,
+                                detail=f"{service.value} returned {response.status}: {await response.text()}")
+        body = await response.json()
+        embeddings = response_parsers[service](body)
+        tokens = token_counters[service](body)
+        if tokens:
+            metrics.embedding_tokens.inc(service.value, model, amount=tokens)
+    if len(embeddings) != len(texts):
+        raise RetryableError(f"{service.value} returned {len(embeddings)} embeddings for {len(texts)} texts")
+    return embeddings
+
+
+async def embed_batch(service: Service, model: str, texts: list[str]) -> list[list[float]]:
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        async with get_semaphore(service):
+            await get_bucket(service).acquire()
+            try:
+                return await post_batch(service, model, texts)
+            except RetryableError as e:
+                error, retry_after = e, e.retry_after
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.embedding_requests.inc(service.value, model, type(e).__name__)
+                error = e
+        if attempt < MAX_RETRIES:
+            await asyncio.sleep(get_backoff(attempt, retry_after))
+    raise HTTPException(status_code=502, detail=f"Embedding with {service.value} failed after "
+                                                f"{MAX_RETRIES + 1} attempts: {error}")
+
+
+async def embed_texts(service: Service, model: str, texts: list[str],
+                      on_batch: Callable[[list[str], list[list[float]]], Awaitable] = None) -> list[list[float]]:
+    batch_size = batch_sizes[service]
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+    async def run_batch(batch: list[str]) -> list[list[float]]:
+        embeddings = await embed_batch(service, model, batch)
+        # Batches are handed back as they finish, so a failed document keeps whatever was already paid for.
+        if on_batch is not None:
+            await on_batch(batch, embeddings)
+        return embeddings
+
+    results = await asyncio.gather(*(run_batch(batch) for batch in batches))
+    return [embedding for embeddings in results for embedding in embeddings]
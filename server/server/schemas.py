@@ -2,7 +2,7 @@ import datetime
 from enum import Enum
 from typing import Optional
 
-from pydantic import BaseModel, UUID4, ConfigDict, Extra
+from pydantic import BaseModel, UUID4, ConfigDict, Extra, Field, computed_field, model_validator
 
 
 class Service(str, Enum):
@@ -12,6 +12,38 @@ class Service(str, Enum):
     google = "Google Generative AI"
 
 
+class ChunkStrategy(str, Enum):
+    character = "character"
+    token = "token"
+    sentence = "sentence"
+
+
+class ChunkingConfig(BaseModel):
+    strategy: ChunkStrategy = ChunkStrategy.character
+    size: int = Field(default=1000, gt=0)
+    overlap: int = Field(default=0, ge=0)
+
+    @model_validator(mode="after")
+    def check_overlap(self) -> "ChunkingConfig":
+        # An overlap as long as the chunk would carry every piece over into the next chunk.
+        if self.overlap >= self.size:
+            raise ValueError("Chunk overlap must be smaller than the chunk size")
+        return self
+
+
+class ProjectionMethod(str, Enum):
+    umap = "umap"
+    umap_pca = "umap_pca"
+    umap_parallel = "umap_parallel"
+    pca = "pca"
+    randomized_svd = "randomized_svd"
+
+
+class ProjectionConfig(BaseModel):
+    method: ProjectionMethod = ProjectionMethod.umap
+    dimensions: int = Field(default=2, ge=2, le=3)
+
+
 class EmbeddingModel(BaseModel):
     service: Service
     model: str
@@ -22,6 +54,8 @@ class Document(BaseModel):
     model_config = ConfigDict(from_attributes=True, populate_by_name=True)
     id: UUID4
     name: str
+    content_hash: Optional[str] = None
+    size: Optional[int] = None
 
 
 class Playground(BaseModel):
@@ -32,11 +66,34 @@ class Playground(BaseModel):
     service: Service
     model: str
     documentNames: Optional[list[str]] = []
+    chunk_strategy: ChunkStrategy = ChunkStrategy.character
+    chunk_size: int = 1000
+    chunk_overlap: int = 0
+    projection_method: ProjectionMethod = ProjectionMethod.umap
+    projection_dimensions: int = 2
+    fitted_points: int = 0
+    changed_points: int = 0
+
+    @property
+    def chunking(self) -> ChunkingConfig:
+        return ChunkingConfig(strategy=self.chunk_strategy, size=self.chunk_size, overlap=self.chunk_overlap)
+
+    @property
+    def projection(self) -> ProjectionConfig:
+        return ProjectionConfig(method=self.projection_method, dimensions=self.projection_dimensions)
+
+    # Share of points added or removed since the projection was last fitted.
+    @computed_field
+    @property
+    def drift(self) -> float:
+        return self.changed_points / self.fitted_points if self.fitted_points else 0
 
 
 class NewPlaygroundRequest(BaseModel):
     service: str
     documents: list[UUID4]
+    chunking: ChunkingConfig = ChunkingConfig()
+    projection: ProjectionConfig = ProjectionConfig()
 
 
 class RenamePlaygroundRequest(BaseModel):
@@ -54,11 +111,58 @@ class Query(BaseModel):
     text: str
 
 
+class BatchQuery(BaseModel):
+    texts: list[str] = Field(min_length=1)
+
+
 class QueryResult(BaseModel):
     id: UUID4
     point: Optional[Point] = None
     results: list[UUID4]
     text: str
+    created: Optional[datetime.datetime] = None
+
+
+class BuildStage(str, Enum):
+    embedding = "embedding"
+    projection = "projection"
+
+
+class BuildStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+
+class PlaygroundBuild(BaseModel):
+    model_config = ConfigDict(from_attributes=True, populate_by_name=True)
+    playground_id: UUID4
+    status: BuildStatus
+    stage: Optional[BuildStage] = None
+    completed_stages: list[BuildStage] = []
+    progress: float = 0
+    error: Optional[str] = None
+    refit: bool = False
+    updated: datetime.datetime
+
+
+class EmbeddingCacheStats(BaseModel):
+    hits: int
+    misses: int
+    entries: int
+
+
+class Readiness(BaseModel):
+    ready: bool
+    subsystems: dict[str, bool]
+    warm: dict[str, bool]
+    warmup_seconds: Optional[float] = None
+
+
+class Neighbour(BaseModel):
+    id: UUID4
+    distance: float
 
 
 class Chunk(BaseModel):
@@ -0,0 +1,90 @@
+import os
+import pickle
+from typing import Optional
+
+import numpy as np
+
+from server.cache import LRUCache
+from server.paths import DATA_PATH
+from server.projection import KNNGraph
+
+umap_store_path = os.path.join(DATA_PATH, "umap")
+
+# Entries are kept with the modification time of the files they were loaded from, and only used while those are
+# unchanged, since a refit in another API worker replaces the files under this one.
+umap_cache = LRUCache(int(os.getenv("UMAP_CACHE_SIZE") or 8), "projection_model")
+knn_cache = LRUCache(int(os.getenv("UMAP_CACHE_SIZE") or 8), "knn_graph")
+
+
+def get_modified(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_umap_path(playground_id: str) -> str:
+    return os.path.join(umap_store_path, f"{playground_id}.pkl")
+
+
+def save_umap_transform(playground_id: str, umap_transform):
+    os.makedirs(umap_store_path, exist_ok=True)
+    path = get_umap_path(playground_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out_file:
+        pickle.dump(umap_transform, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    umap_cache.put(playground_id, (get_modified(path), umap_transform))
+
+
+def load_umap_transform(playground_id: str):
+    path = get_umap_path(playground_id)
+    modified = get_modified(path)
+    if modified is None:
+        return None
+    cached = umap_cache.get(playground_id)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    with open(path, "rb") as in_file:
+        umap_transform = pickle.load(in_file)
+    umap_cache.put(playground_id, (modified, umap_transform))
+    return umap_transform
+
+
+def get_knn_paths(playground_id: str) -> dict[str, str]:
+    return {field: os.path.join(umap_store_path, f"{playground_id}-knn-{field}.npy") for field in KNNGraph._fields}
+
+
+def save_knn_graph(playground_id: str, knn_graph: KNNGraph):
+    os.makedirs(umap_store_path, exist_ok=True)
+    paths = get_knn_paths(playground_id)
+    for field, array in knn_graph._asdict().items():
+        tmp_path = f"{paths[field]}.tmp"
+        with open(tmp_path, "wb") as out_file:
+            np.save(out_file, array)
+        os.replace(tmp_path, paths[field])
+    knn_cache.pop(playground_id)
+
+
+def load_knn_graph(playground_id: str) -> Optional[KNNGraph]:
+    paths = get_knn_paths(playground_id)
+    modified = tuple(get_modified(path) for path in paths.values())
+    if None in modified:
+        return None
+    cached = knn_cache.get(playground_id)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+
+    # Memory mapped, so every worker shares the page cache rather than holding its own copy.
+    knn_graph = KNNGraph(**{field: np.load(path, mmap_mode="r") for field, path in paths.items()})
+    knn_cache.put(playground_id, (modified, knn_graph))
+    return knn_graph
+
+
+def delete_umap_transform(playground_id: str):
+    umap_cache.pop(playground_id)
+    knn_cache.pop(playground_id)
+    for path in [get_umap_path(playground_id), *get_knn_paths(playground_id).values()]:
+        if os.path.exists(path):
+            os.remove(path)
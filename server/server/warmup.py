@@ -0,0 +1,86 @@
+import asyncio
+import importlib
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+from server.chunking import chunk_texts
+from server.embedding_models import embed_texts, models
+from server.executors import run_blocking, run_cpu, run_embedding, CPU_WORKERS
+from server.projection import fit_projection
+from server.schemas import ChunkingConfig, ProjectionConfig, Readiness, Service
+
+logger = logging.getLogger(__name__)
+
+WARMUP = (os.getenv("WARMUP") or "true").lower() == "true"
+WARMUP_LOCAL_EMBEDDINGS = (os.getenv("WARMUP_LOCAL_EMBEDDINGS") or "true").lower() == "true"
+
+# Set by startup as each subsystem a request can't do without comes up.
+ready: dict[str, bool] = {"database": False, "point_store": False, "vector_store": False, "build_workers": False}
+# Set by the background warmup, requests work before these are warm, only slower.
+warm: dict[str, bool] = {"cpu_workers": False, "projection": False, "local_embeddings": False}
+warmup_seconds: Optional[float] = None
+warmup_task: Optional[asyncio.Task] = None
+
+
+def warm_cpu_worker() -> int:
+    # A tiny fit compiles the numba code UMAP runs, which NUMBA_CACHE_DIR then keeps across restarts.
+    list(chunk_texts(["Warm up."], ChunkingConfig()))
+    importlib.import_module("pypdf")
+    fit_projection(np.random.default_rng(0).random((64, 8), dtype=np.float32), ProjectionConfig())
+    return os.getpid()
+
+
+def warm_local_embeddings():
+    embed_texts(Service.sentenceTransformers, models[Service.sentenceTransformers], ["Warm up."])
+
+
+def warm_projection():
+    # UMAP models that aren't fitted on a kNN graph are unpickled and run in this process for query points.
+    importlib.import_module("umap")
+
+
+async def warm_step(name: str, step: Callable):
+    started = time.perf_counter()
+    try:
+        await step()
+        warm[name] = True
+        logger.info(f"Warmed up {name} in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        logger.error(f"Failed to warm up {name}: {e}")
+
+
+async def warm_cpu_workers():
+    # Each worker takes one task while the others are busy with theirs, so every process gets spawned and warmed.
+    pids = await asyncio.gather(*(run_cpu(warm_cpu_worker) for _ in range(CPU_WORKERS)))
+    logger.info(f"Warmed up {len(set(pids))} of {CPU_WORKERS} CPU workers")
+
+
+async def warm_up():
+    global warmup_seconds
+    started = time.perf_counter()
+    steps = [warm_step("cpu_workers", warm_cpu_workers),
+             warm_step("projection", lambda: run_blocking(warm_projection))]
+    if WARMUP_LOCAL_EMBEDDINGS:
+        steps.append(warm_step("local_embeddings", lambda: run_embedding(warm_local_embeddings)))
+    await asyncio.gather(*steps)
+    warmup_seconds = time.perf_counter() - started
+
+
+def start_warmup():
+    global warmup_task
+    if WARMUP:
+        warmup_task = asyncio.create_task(warm_up())
+
+
+async def stop_warmup():
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+        await asyncio.gather(warmup_task, return_exceptions=True)
+
+
+def get_readiness() -> Readiness:
+    return Readiness(ready=all(ready.values()), subsystems=ready, warm=warm, warmup_seconds=warmup_seconds)
@@ -0,0 +1,81 @@
+import contextlib
+import unittest
+import uuid
+from unittest import mock
+
+import httpx
+from fastapi import HTTPException
+
+from server import api, db
+from server.api import app, get_db_connection, stream_query_results
+from server.schemas import QueryResult
+
+
+def make_results(texts: list[str]) -> list[QueryResult]:
+    return [QueryResult(id=uuid.uuid4(), results=[uuid.uuid4()], text=text) for text in texts]
+
+
+class FakePool:
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield "batch connection"
+
+
+class StreamQueryResultsTest(unittest.IsolatedAsyncioTestCase):
+    async def test_batches_are_submitted_as_the_stream_is_read(self):
+        submitted = []
+
+        async def submit(texts):
+            submitted.append(texts)
+            return make_results(texts)
+
+        stream = stream_query_results(make_results(["a"]), [["b", "c"], ["d"]], submit)
+        self.assertEqual(QueryResult.model_validate_json(await anext(stream)).text, "a")
+        self.assertEqual(submitted, [])
+        self.assertEqual(QueryResult.model_validate_json(await anext(stream)).text, "b")
+        self.assertEqual(submitted, [["b", "c"]])
+        rest = [QueryResult.model_validate_json(line).text async for line in stream]
+        self.assertEqual(rest, ["c", "d"])
+        self.assertEqual(submitted, [["b", "c"], ["d"]])
+
+
+class BatchQueryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async def get_test_connection():
+            yield "request connection"
+
+        app.dependency_overrides[get_db_connection] = get_test_connection
+        self.addCleanup(app.dependency_overrides.clear)
+        self.connections = []
+
+        async def submit_queries(conn, playground, texts):
+            self.connections.append(conn)
+            return make_results(texts)
+
+        for patch in [mock.patch.object(api, "BATCH_QUERY_SIZE", 2),
+                      mock.patch.object(api, "read_playgrounds", mock.AsyncMock(return_value=[mock.Mock()])),
+                      mock.patch.object(api, "submit_queries", side_effect=submit_queries),
+                      mock.patch.object(db, "get_pool", return_value=FakePool())]:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+        self.addAsyncCleanup(self.client.aclose)
+
+    async def test_streams_one_result_per_line(self):
+        texts = ["a", "b", "c", "d", "e"]
+        response = await self.client.post(f"/playgrounds/{uuid.uuid4()}/query/batch", json={"texts": texts})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        lines = response.text.splitlines()
+        self.assertEqual([QueryResult.model_validate_json(line).text for line in lines], texts)
+        # The first batch runs on the request's connection, the streamed ones on their own.
+        self.assertEqual(self.connections, ["request connection", "batch connection", "batch connection"])
+
+    async def test_first_batch_errors_keep_their_status(self):
+        api.submit_queries.side_effect = HTTPException(status_code=409, detail="Playground is building")
+        response = await self.client.post(f"/playgrounds/{uuid.uuid4()}/query/batch", json={"texts": ["a", "b", "c"]})
+        self.assertEqual(response.status_code, 409)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import time
+import unittest
+from unittest import mock
+
+from server.cache import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(4, ttl=10)
+        with mock.patch.object(time, "monotonic", return_value=100):
+            cache.put("a", 1)
+        with mock.patch.object(time, "monotonic", return_value=109):
+            self.assertEqual(cache.get("a"), 1)
+        with mock.patch.object(time, "monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+        self.assertNotIn("a", cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_pop_returns_value_without_expiry(self):
+        cache = LRUCache(4, ttl=10)
+        cache.put("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.pop("a"))
+
+    def test_pop_where(self):
+        cache = LRUCache(4, ttl=10)
+        for key in [("p1", 1), ("p1", 2), ("p2", 1)]:
+            cache.put(key, key[1])
+        self.assertEqual(cache.pop_where(lambda key: key[0] == "p1"), 2)
+        self.assertEqual(len(cache), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from server.chunking import pack_chunks
+
+
+def pack(pieces: list[str], chunk_size: int, chunk_overlap: int) -> list[str]:
+    return list(pack_chunks(pieces, chunk_size, chunk_overlap, len, " "))
+
+
+class PackChunksTest(unittest.TestCase):
+    def test_packs_pieces_up_to_chunk_size(self):
+        self.assertEqual(pack(["aa", "bb", "cc", "dd", "ee"], 4, 0), ["aa bb", "cc dd", "ee"])
+
+    def test_carries_over_pieces_within_overlap(self):
+        self.assertEqual(pack(["aa", "bb", "cc", "dd", "ee"], 6, 2), ["aa bb cc", "cc dd ee"])
+
+    def test_overlap_never_pushes_a_chunk_over_size(self):
+        chunks = pack(["aaa", "bbb", "cccc"], 6, 3)
+        self.assertEqual(chunks, ["aaa bbb", "cccc"])
+
+    def test_oversized_piece_is_its_own_chunk(self):
+        self.assertEqual(pack(["a", "bbbbbbbb", "c"], 4, 0), ["a", "bbbbbbbb", "c"])
+
+    def test_no_pieces(self):
+        self.assertEqual(pack([], 4, 0), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
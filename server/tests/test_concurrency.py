@@ -0,0 +1,45 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import httpx
+
+from benchmarks.synthetic_pdf import write_pdf
+from server.api import app
+from server.chunking import chunk_document
+from server.executors import shutdown_executors
+from server.schemas import ChunkingConfig
+
+
+class ConcurrentRequestsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.pdf_path = os.path.join(self.tmp_dir.name, "document.pdf")
+        write_pdf(self.pdf_path, 200)
+
+    def tearDown(self):
+        shutdown_executors()
+        self.tmp_dir.cleanup()
+
+    async def test_requests_are_served_while_a_build_runs(self):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            # Chunking is the first build stage, it runs in the CPU pool and page ranges are handed back to the loop.
+            build = asyncio.create_task(chunk_document(self.pdf_path, ChunkingConfig()))
+            rounds_during_build = 0
+            while not build.done():
+                responses = await asyncio.gather(*(client.get("/models") for _ in range(10)))
+                self.assertTrue(all(response.status_code == 200 for response in responses))
+                # A loop blocked by the build would only get to the requests once it had finished.
+                if not build.done():
+                    rounds_during_build += 1
+                await asyncio.sleep(0.05)
+            chunks = await build
+
+        self.assertTrue(chunks)
+        self.assertGreater(rounds_during_build, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
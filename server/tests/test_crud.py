@@ -0,0 +1,30 @@
+import datetime
+import unittest
+import uuid
+
+from fastapi import HTTPException
+
+from server.crud import decode_query_cursor, encode_query_cursor
+from server.schemas import QueryResult
+
+
+class QueryCursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        created = datetime.datetime(2024, 3, 8, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc)
+        query = QueryResult(id=uuid.uuid4(), results=[], text="question", created=created)
+        self.assertEqual(decode_query_cursor(encode_query_cursor(query)), (created, query.id))
+
+    def test_cursor_is_url_safe(self):
+        query = QueryResult(id=uuid.uuid4(), results=[], text="question", created=datetime.datetime.now())
+        cursor = encode_query_cursor(query)
+        self.assertTrue(all(c.isalnum() or c in "-_=" for c in cursor))
+
+    def test_invalid_cursor(self):
+        for cursor in ["not a cursor", "bm90IGEgY3Vyc29y", ""]:
+            with self.assertRaises(HTTPException) as context:
+                decode_query_cursor(cursor)
+            self.assertEqual(context.exception.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import hashlib
+import unittest
+from unittest import mock
+
+from server import embedding_cache, local_embeddings
+from server.local_embeddings import LocalBackend
+from server.schemas import Service
+
+MODEL = "all-MiniLM-L6-v2"
+
+
+class EmbeddingCacheKeyTest(unittest.TestCase):
+    def get_local_key(self, backend: LocalBackend, int8: bool) -> bytes:
+        local_embeddings.get_local_variant.cache_clear()
+        with mock.patch.object(local_embeddings, "LOCAL_EMBEDDING_BACKEND", backend), \
+                mock.patch.object(local_embeddings, "LOCAL_EMBEDDING_INT8", int8):
+            return embedding_cache.get_key(Service.sentenceTransformers, MODEL, "text")
+
+    def tearDown(self):
+        local_embeddings.get_local_variant.cache_clear()
+
+    def test_plain_torch_keeps_its_key(self):
+        expected = hashlib.sha256(f"{Service.sentenceTransformers.value}\0{MODEL}\0text".encode()).digest()
+        self.assertEqual(self.get_local_key(LocalBackend.torch, False), expected)
+
+    def test_backends_and_int8_get_their_own_keys(self):
+        keys = {self.get_local_key(LocalBackend.torch, False), self.get_local_key(LocalBackend.torch, True),
+                self.get_local_key(LocalBackend.onnx, False)}
+        self.assertEqual(len(keys), 3)
+
+    def test_remote_keys_ignore_local_settings(self):
+        key = embedding_cache.get_key(Service.openAI, "model", "text")
+        with mock.patch.object(local_embeddings, "LOCAL_EMBEDDING_INT8", True):
+            self.assertEqual(embedding_cache.get_key(Service.openAI, "model", "text"), key)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+import unittest
+import uuid
+from unittest import mock
+
+import httpx
+from fastapi import HTTPException
+
+from server import api, file_store
+from server.api import app, get_db_connection
+from server.file_store import parse_range
+from server.schemas import Document
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_no_or_unsupported_range(self):
+        self.assertIsNone(parse_range(None, 100))
+        self.assertIsNone(parse_range("bytes=-", 100))
+        self.assertIsNone(parse_range("bytes=0-10,20-30", 100))
+        self.assertIsNone(parse_range("items=0-10", 100))
+
+    def test_closed_range(self):
+        self.assertEqual(parse_range("bytes=10-19", 100), (10, 19))
+
+    def test_open_range(self):
+        self.assertEqual(parse_range("bytes=90-", 100), (90, 99))
+
+    def test_end_is_clamped_to_size(self):
+        self.assertEqual(parse_range("bytes=50-500", 100), (50, 99))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range("bytes=-500", 100), (0, 99))
+
+    def test_range_past_the_end(self):
+        with self.assertRaises(HTTPException) as context:
+            parse_range("bytes=100-", 100)
+        self.assertEqual(context.exception.status_code, 416)
+        self.assertEqual(context.exception.headers["Content-Range"], "bytes */100")
+
+
+
+class UploadLimitTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patch = mock.patch.object(file_store, "MAX_UPLOAD_BODY_BYTES", 1024)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+        self.addAsyncCleanup(self.client.aclose)
+
+    async def test_rejects_on_content_length(self):
+        response = await self.client.post("/documents/upload", files={"file": ("big.pdf", b"x" * 4096)})
+        self.assertEqual(response.status_code, 413)
+
+    async def test_rejects_streamed_body_over_limit(self):
+        async def body():
+            yield b'--b\r\nContent-Disposition: form-data; name="file"; filename="big.pdf"\r\n\r\n'
+            for _ in range(8):
+                yield b"x" * 512
+            yield b"\r\n--b--\r\n"
+
+        # A streamed body has no Content-Length, the limit is enforced while it is read.
+        response = await self.client.post("/documents/upload", content=body(),
+                                          headers={"Content-Type": "multipart/form-data; boundary=b"})
+        self.assertEqual(response.status_code, 413)
+
+
+class FakeConnection:
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class UploadTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        patch = mock.patch.object(file_store, "file_store_path", tmp_dir.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        async def get_test_connection():
+            yield FakeConnection()
+
+        app.dependency_overrides[get_db_connection] = get_test_connection
+        self.addCleanup(app.dependency_overrides.clear)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+        self.addAsyncCleanup(self.client.aclose)
+
+    async def test_stores_file_under_its_hash(self):
+        content_hash = hashlib.sha256(b"content").hexdigest()
+        document = Document(id=uuid.uuid4(), name="a.pdf", content_hash=content_hash, size=7)
+        with mock.patch.object(api, "create_doc", mock.AsyncMock(return_value=(document, True))):
+            response = await self.client.post("/documents/upload", files={"file": ("a.pdf", b"content")})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(os.listdir(file_store.file_store_path), [content_hash])
+
+    async def test_failed_insert_leaves_no_file(self):
+        with mock.patch.object(api, "create_doc", mock.AsyncMock(side_effect=RuntimeError("insert failed"))):
+            response = await self.client.post("/documents/upload", files={"file": ("a.pdf", b"content")})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(os.listdir(file_store.file_store_path), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
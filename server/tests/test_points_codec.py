@@ -0,0 +1,49 @@
+import unittest
+import uuid
+
+import numpy as np
+
+from server.points_codec import Projection, compress, decode_points, encode_points, get_etag, uuid_bytes
+
+
+class PointsCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = [str(uuid.uuid4()) for _ in range(100)]
+        self.coordinates = np.random.default_rng(0).normal(size=(100, 3)).astype(np.float32)
+
+    def test_round_trip(self):
+        ids, coordinates = decode_points(encode_points(uuid_bytes(self.ids), self.coordinates))
+        self.assertEqual([str(point_id) for point_id in ids], self.ids)
+        np.testing.assert_array_equal(coordinates, self.coordinates)
+
+    def test_round_trip_2d(self):
+        ids, coordinates = decode_points(encode_points(uuid_bytes(self.ids), self.coordinates[:, :2]))
+        self.assertEqual(coordinates.shape, (100, 2))
+        np.testing.assert_array_equal(coordinates, self.coordinates[:, :2])
+
+    def test_empty(self):
+        ids, coordinates = decode_points(encode_points(uuid_bytes([]), np.empty((0, 3), dtype=np.float32)))
+        self.assertEqual(ids, [])
+        self.assertEqual(coordinates.shape, (0, 3))
+
+    def test_rejects_other_payloads(self):
+        with self.assertRaises(ValueError):
+            decode_points(b"\x00" * 32)
+
+    def test_etag_follows_version(self):
+        first = Projection(1, uuid_bytes(self.ids), self.coordinates)
+        self.assertEqual(get_etag(first), get_etag(first._replace(coordinates=self.coordinates * 2)))
+        self.assertNotEqual(get_etag(first), get_etag(first._replace(version=2)))
+        self.assertTrue(get_etag(first).startswith('"') and get_etag(first).endswith('"'))
+
+    def test_compress(self):
+        payload = encode_points(uuid_bytes(self.ids), np.zeros((100, 3), dtype=np.float32))
+        compressed, encoding = compress(payload, "gzip, deflate")
+        self.assertEqual(encoding, "gzip")
+        self.assertLess(len(compressed), len(payload))
+        self.assertEqual(compress(payload, "identity"), (payload, None))
+        self.assertEqual(compress(payload[:100], "gzip"), (payload[:100], None))
+
+
+if __name__ == "__main__":
+    unittest.main()
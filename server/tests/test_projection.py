@@ -0,0 +1,27 @@
+import subprocess
+import sys
+import unittest
+
+# A fresh interpreter, other tests may already have imported umap into this one.
+FIT_SCRIPT = """
+import sys
+import numpy as np
+from server.projection import fit_projection, project_embeddings
+from server.schemas import ProjectionConfig
+embeddings = np.random.default_rng(0).random((100, 16), dtype=np.float32)
+projection = fit_projection(embeddings, ProjectionConfig(method="{method}", dimensions=2))
+assert project_embeddings(embeddings[:4], projection).shape == (4, 2)
+print("umap" in sys.modules)
+"""
+
+
+class FitProjectionTest(unittest.TestCase):
+    def test_linear_projections_do_not_import_umap(self):
+        for method in ["pca", "randomized_svd"]:
+            result = subprocess.run([sys.executable, "-c", FIT_SCRIPT.format(method=method)], capture_output=True,
+                                    text=True, check=True)
+            self.assertEqual(result.stdout.strip(), "False")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from unittest import mock
+
+from fastapi import HTTPException
+
+from benchmarks.mock_provider import MockProvider, fake_embedding
+from server import remote_embeddings
+from server.schemas import Service
+
+
+class RemoteEmbeddingsTest(unittest.IsolatedAsyncioTestCase):
+    async def start_provider(self, error_rate: float) -> MockProvider:
+        provider = MockProvider(latency=0.01, error_rate=error_rate, dimensions=8, seed=1)
+        runner, base_url = await provider.start()
+        self.addAsyncCleanup(runner.cleanup)
+        self.addAsyncCleanup(remote_embeddings.close_session)
+        patches = [
+            mock.patch.dict(remote_embeddings.base_urls, {Service.openAI: f"{base_url}/openai"}),
+            mock.patch.dict(remote_embeddings.batch_sizes, {Service.openAI: 4}),
+            mock.patch.object(remote_embeddings, "BACKOFF_BASE_SECONDS", 0.01),
+            mock.patch.object(remote_embeddings, "BACKOFF_MAX_SECONDS", 0.05),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        return provider
+
+    async def test_failed_batches_are_retried(self):
+        provider = await self.start_provider(error_rate=0.3)
+        texts = [f"text {i}" for i in range(40)]
+        batches = []
+
+        async def on_batch(batch, embeddings):
+            batches.append(batch)
+
+        embeddings = await remote_embeddings.embed_texts(Service.openAI, "model", texts, on_batch)
+
+        self.assertGreater(provider.errors, 0)
+        self.assertEqual(provider.requests, len(batches) + provider.errors)
+        self.assertEqual(sorted(text for batch in batches for text in batch), sorted(texts))
+        for text, embedding in zip(texts, embeddings):
+            self.assertEqual(embedding, fake_embedding(text, 8))
+
+    async def test_gives_up_after_max_retries(self):
+        provider = await self.start_provider(error_rate=1)
+        with mock.patch.object(remote_embeddings, "MAX_RETRIES", 2):
+            with self.assertRaises(HTTPException) as context:
+                await remote_embeddings.embed_texts(Service.openAI, "model", ["text"])
+        self.assertEqual(context.exception.status_code, 502)
+        self.assertEqual(provider.requests, 3)
+
+    def test_backoff_honours_retry_after(self):
+        self.assertEqual(remote_embeddings.get_backoff(0, 2.5), 2.5)
+        self.assertEqual(remote_embeddings.get_backoff(3, 10 ** 6), remote_embeddings.BACKOFF_MAX_SECONDS)
+        self.assertIsNone(remote_embeddings.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"))
+        self.assertEqual(remote_embeddings.parse_retry_after("0.1"), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
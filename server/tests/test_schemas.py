@@ -0,0 +1,23 @@
+import unittest
+
+from pydantic import ValidationError
+
+from server.schemas import ChunkingConfig, NewPlaygroundRequest
+
+
+class ChunkingConfigTest(unittest.TestCase):
+    def test_overlap_below_size(self):
+        self.assertEqual(ChunkingConfig(size=100, overlap=99).overlap, 99)
+
+    def test_overlap_not_below_size(self):
+        for overlap in [100, 150]:
+            with self.assertRaises(ValidationError):
+                ChunkingConfig(size=100, overlap=overlap)
+
+    def test_rejected_in_playground_requests(self):
+        with self.assertRaises(ValidationError):
+            NewPlaygroundRequest(service="OpenAI", documents=[], chunking={"size": 10, "overlap": 10})
+
+
+if __name__ == "__main__":
+    unittest.main()